@@ -4,10 +4,27 @@
 import logging
 from io import BytesIO
 import zipfile
-from odoo import api, models
+from odoo import _, api, models
+from odoo.exceptions import UserError
+
+from .parser import iter_in_workers
 
 _logger = logging.getLogger(__name__)
 
+# Local file header, or end of central directory for an empty archive
+ZIP_MAGIC = (b'PK\x03\x04', b'PK\x05\x06')
+
+
+def parse_zip_member_in_worker(parser, member_data):
+    """Parse the data of an archive member as camt file, in a worker process.
+
+    Return None if the member is not a camt file."""
+    try:
+        # Workers must not read the configuration from the database
+        return parser.parse(member_data, max_workers=0)
+    except ValueError:
+        return None
+
 
 class AccountBankStatementImport(models.TransientModel):
     """Add process_camt method to account.bank.statement.import."""
@@ -16,25 +33,75 @@ class AccountBankStatementImport(models.TransientModel):
     @api.model
     def _parse_file(self, data_file):
         """Parse a CAMT053 XML file."""
+        if data_file[:4] in ZIP_MAGIC:
+            try:
+                return self._merge_zip_results(
+                    self._parse_zip_members(data_file))
+            except (zipfile.BadZipFile, ValueError):
+                _logger.debug("Statement file was not a valid zip file.",
+                              exc_info=True)
+            return super(AccountBankStatementImport, self)._parse_file(
+                data_file)
         try:
             parser = self.env['account.bank.statement.import.camt.parser']
             _logger.debug("Try parsing with camt.")
             return parser.parse(data_file)
         except ValueError:
-            try:
-                with zipfile.ZipFile(BytesIO(data_file)) as data:
-                    currency = None
-                    account_number = None
-                    transactions = []
-                    for member in data.namelist():
-                        currency, account_number, new = self._parse_file(
-                            data.open(member).read()
-                        )
-                        transactions.extend(new)
-                return currency, account_number, transactions
-            except (zipfile.BadZipFile, ValueError):
-                pass
             # Not a camt file, returning super will call next candidate:
             _logger.debug("Statement file was not a camt file.",
                           exc_info=True)
         return super(AccountBankStatementImport, self)._parse_file(data_file)
+
+    @api.model
+    def _parse_zip_members(self, data_file):
+        """Return currency, account number and statements of each member.
+
+        Members are read one at a time. If configured for the camt parser,
+        they are parsed by a pool of processes. Members that are not camt
+        files are parsed here, by all available formats, once the pool is
+        done: they may be archives to parse in parallel as well."""
+        parser = self.env['account.bank.statement.import.camt.parser']
+        max_workers, threshold = parser._get_parallel_config()
+        with zipfile.ZipFile(BytesIO(data_file)) as data:
+            names = [
+                info.filename for info in data.infolist()
+                if not info.filename.endswith('/')
+            ]
+            if max_workers < 2 or len(names) < threshold:
+                return [
+                    self._parse_file(data.read(name)) for name in names
+                ]
+            results = list(iter_in_workers(
+                parser, parse_zip_member_in_worker,
+                ((data.read(name),) for name in names), max_workers))
+            return [
+                result if result is not None
+                else self._parse_file(data.read(name))
+                for name, result in zip(names, results)
+            ]
+
+    @api.model
+    def _merge_zip_results(self, results):
+        """Merge the statements of all archive members.
+
+        All members must be for the same account and currency, as these
+        determine the journal the statements are imported in."""
+        currencies = []
+        account_numbers = []
+        statements = []
+        for currency, account_number, member_statements in results:
+            if currency and currency not in currencies:
+                currencies.append(currency)
+            if account_number and account_number not in account_numbers:
+                account_numbers.append(account_number)
+            statements.extend(member_statements)
+        if len(currencies) > 1 or len(account_numbers) > 1:
+            raise UserError(_(
+                "The archive contains statements for several accounts or "
+                "currencies (%s). Please import them separately."
+            ) % ', '.join(account_numbers + currencies))
+        return (
+            currencies and currencies[0] or None,
+            account_numbers and account_numbers[0] or None,
+            statements,
+        )
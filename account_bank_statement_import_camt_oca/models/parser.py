@@ -2,32 +2,142 @@
 # © 2013-2016 Therp BV <http://therp.nl>
 # Copyright 2017 Open Net Sàrl
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+import codecs
+import collections
+import itertools
+import logging
 import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
 from lxml import etree
 
-from odoo import models
+from odoo import _, models
+from odoo.exceptions import UserError
+
+# Compiled XPath expressions per namespace, see CamtParser.xpath
+_xpath_cache = {}
+_XPATH_CACHE_MAX_NAMESPACES = 32
+
+RE_CAMT = re.compile(
+    r'(^urn:iso:std:iso:20022:tech:xsd:camt.'
+    r'|^ISO:camt.)'
+)
+RE_CAMT_VERSION = re.compile(
+    r'(^urn:iso:std:iso:20022:tech:xsd:camt.054.'
+    r'|^urn:iso:std:iso:20022:tech:xsd:camt.053.'
+    r'|^urn:iso:std:iso:20022:tech:xsd:camt.052.'
+    r'|^ISO:camt.054.'
+    r'|^ISO:camt.053.'
+    r'|^ISO:camt.052.)'
+)
+
+_logger = logging.getLogger(__name__)
+
+# Encoding given in the XML declaration, if any
+RE_XML_ENCODING = re.compile(
+    br'^\s*<\?xml[^>]*?\sencoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+# Number of bytes decoded at once by CamtParser.sniff_encoding
+ENCODING_CHUNK_SIZE = 65536
+# Encoding used for files that turn out not to be UTF-8. ABNAmro is known to
+# mix up encodings.
+FALLBACK_ENCODING = 'iso-8859-15'
+# Number of files parsed per encoding path in this process, see
+# CamtParser.parse. Each path is also logged at info level, with a stable
+# message that log monitoring can count across workers.
+encoding_path_counts = collections.Counter()
+ENCODING_PATH_LOG = "camt encoding path: %s"
+
+# Parser used by the worker processes of iter_in_workers. Workers are forked
+# while it is set, so they share the parser of the import. Models cannot be
+# passed to the workers as arguments, so the lock keeps concurrent imports
+# from forking workers with the parser of another import.
+_worker_parser = None
+_worker_lock = threading.Lock()
+
+
+def _call_in_worker(function, args):
+    """Call function with the parser of the import, in a worker process."""
+    return function(_worker_parser, *args)
+
+
+def iter_in_workers(parser, function, args_iter, max_workers):
+    """Yield function(parser, *args) for each args of args_iter, in order.
+
+    The calls are made by a pool of max_workers processes. At most two calls
+    per worker are queued at any time. The lock is held until the last
+    result is yielded, so the caller must not start workers again while
+    consuming the results."""
+    global _worker_parser
+    with _worker_lock:
+        _worker_parser = parser
+        try:
+            pending = collections.deque()
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                for args in args_iter:
+                    pending.append(
+                        executor.submit(_call_in_worker, function, args))
+                    if len(pending) >= 2 * max_workers:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+        finally:
+            _worker_parser = None
+
+
+def parse_statement_in_worker(parser, ns, data):
+    """Parse a serialized Stmt node in a worker process."""
+    return parser.parse_statement(ns, etree.fromstring(data))
 
 
 class CamtParser(models.AbstractModel):
     """Parser for camt bank statement import files."""
     _name = 'account.bank.statement.import.camt.parser'
 
+    def xpath(self, ns, node, path):
+        """Return the nodes found with path (using prefix ns) from node.
+
+        Each path is compiled only once per namespace, that is per camt
+        version, instead of on every call."""
+        compiled_paths = _xpath_cache.get(ns)
+        if compiled_paths is None:
+            if len(_xpath_cache) >= _XPATH_CACHE_MAX_NAMESPACES:
+                _xpath_cache.clear()
+            compiled_paths = _xpath_cache[ns] = {}
+        compiled = compiled_paths.get(path)
+        if compiled is None:
+            compiled = compiled_paths[path] = etree.XPath(
+                path, namespaces={'ns': ns})
+        return compiled(node)
+
+    def _is_overridden(self, method_name):
+        """Return whether another module overrides a method of the parser."""
+        return getattr(type(self), method_name) is not getattr(
+            CamtParser, method_name)
+
     def parse_amount(self, ns, node):
         """Parse element that contains Amount and CreditDebitIndicator."""
+        return self._parse_amount(ns, node)
+
+    def _parse_amount(self, ns, node, sign=None):
+        """Parse element that contains Amount and CreditDebitIndicator.
+
+        If the element has no CreditDebitIndicator of its own, sign is used
+        when given. Otherwise the indicator is looked up two levels up."""
         if node is None:
             return 0.0
-        sign = 1
         amount = 0.0
-        sign_node = node.xpath('ns:CdtDbtInd', namespaces={'ns': ns})
-        if not sign_node:
-            sign_node = node.xpath(
-                '../../ns:CdtDbtInd', namespaces={'ns': ns})
-        if sign_node and sign_node[0].text == 'DBIT':
-            sign = -1
-        amount_node = node.xpath('ns:Amt', namespaces={'ns': ns})
+        sign_node = self.xpath(ns, node, 'ns:CdtDbtInd')
+        if not sign_node and sign is None:
+            sign_node = self.xpath(ns, node, '../../ns:CdtDbtInd')
+        if sign_node:
+            sign = -1 if sign_node[0].text == 'DBIT' else 1
+        elif sign is None:
+            sign = 1
+        amount_node = self.xpath(ns, node, 'ns:Amt')
         if not amount_node:
-            amount_node = node.xpath(
-                './ns:AmtDtls/ns:TxAmt/ns:Amt', namespaces={'ns': ns})
+            amount_node = self.xpath(
+                ns, node, './ns:AmtDtls/ns:TxAmt/ns:Amt')
         if amount_node:
             amount = sign * float(amount_node[0].text)
         return amount
@@ -42,7 +152,7 @@ class CamtParser(models.AbstractModel):
         if not isinstance(xpath_str, (list, tuple)):
             xpath_str = [xpath_str]
         for search_str in xpath_str:
-            found_node = node.xpath(search_str, namespaces={'ns': ns})
+            found_node = self.xpath(ns, node, search_str)
             if found_node:
                 if join_str is None:
                     attr_value = found_node[0].text
@@ -53,6 +163,15 @@ class CamtParser(models.AbstractModel):
 
     def parse_transaction_details(self, ns, node, transaction):
         """Parse TxDtls node."""
+        self._parse_transaction_details(
+            ns, node, transaction, self.get_entry_context(
+                ns, node.getparent().getparent(), transaction=False))
+
+    def _parse_transaction_details(self, ns, node, transaction, entry_context):
+        """Parse TxDtls node, with the values of its Ntry node.
+
+        entry_context holds the values of the parent Ntry node, as returned
+        by get_entry_context."""
         # message
         self.add_value_from_node(
             ns, node, [
@@ -74,28 +193,24 @@ class CamtParser(models.AbstractModel):
             ],
             transaction, 'ref'
         )
-        amount = self.parse_amount(ns, node)
+        if self._is_overridden('parse_amount'):
+            amount = self.parse_amount(ns, node)
+        else:
+            amount = self._parse_amount(ns, node, sign=entry_context['sign'])
         if amount != 0.0:
             transaction['amount'] = amount
         # remote party values
-        party_type = 'Dbtr'
-        party_type_node = node.xpath(
-            '../../ns:CdtDbtInd', namespaces={'ns': ns})
-        if party_type_node and party_type_node[0].text != 'CRDT':
-            party_type = 'Cdtr'
-        party_node = node.xpath(
-            './ns:RltdPties/ns:%s' % party_type, namespaces={'ns': ns})
+        party_type = entry_context['party_type']
+        party_node = self.xpath(
+            ns, node, './ns:RltdPties/ns:%s' % party_type)
         if party_node:
             self.add_value_from_node(
                 ns, party_node[0], './ns:Nm', transaction, 'partner_name')
         # Get remote_account from iban or from domestic account:
-        account_node = node.xpath(
-            './ns:RltdPties/ns:%sAcct/ns:Id' % party_type,
-            namespaces={'ns': ns}
-        )
+        account_node = self.xpath(
+            ns, node, './ns:RltdPties/ns:%sAcct/ns:Id' % party_type)
         if account_node:
-            iban_node = account_node[0].xpath(
-                './ns:IBAN', namespaces={'ns': ns})
+            iban_node = self.xpath(ns, account_node[0], './ns:IBAN')
             if iban_node:
                 transaction['account_number'] = iban_node[0].text
             else:
@@ -104,8 +219,21 @@ class CamtParser(models.AbstractModel):
                     'account_number'
                 )
 
-    def parse_entry(self, ns, node):
-        """Parse an Ntry node and yield transactions"""
+    def get_entry_context(self, ns, node, transaction=True):
+        """Return the values of an Ntry node shared by all its details.
+
+        These are the sign of the amounts, the type of the remote party and,
+        unless transaction is False, the transaction values of the entry
+        itself."""
+        sign_node = self.xpath(ns, node, 'ns:CdtDbtInd')
+        # Without indicator, amounts are credits and the party the debtor
+        indicator = sign_node[0].text if sign_node else 'CRDT'
+        entry_context = {
+            'sign': -1 if indicator == 'DBIT' else 1,
+            'party_type': 'Dbtr' if indicator == 'CRDT' else 'Cdtr',
+        }
+        if not transaction:
+            return entry_context
         transaction = {'name': '/', 'amount': 0}  # fallback defaults
         self.add_value_from_node(
             ns, node, './ns:BookgDt/ns:Dt', transaction, 'date')
@@ -122,18 +250,42 @@ class CamtParser(models.AbstractModel):
             ],
             transaction, 'ref'
         )
+        entry_context['transaction'] = transaction
+        return entry_context
 
-        details_nodes = node.xpath(
-            './ns:NtryDtls/ns:TxDtls', namespaces={'ns': ns})
+    def parse_entry(self, ns, node):
+        """Parse an Ntry node and yield transactions"""
+        entry_context = self.get_entry_context(ns, node)
+        details_nodes = self.xpath(ns, node, './ns:NtryDtls/ns:TxDtls')
         if len(details_nodes) == 0:
-            yield transaction
+            yield entry_context['transaction']
             return
-        transaction_base = transaction
+        # Overrides of parse_transaction_details look up the entry values
+        with_context = not self._is_overridden('parse_transaction_details')
         for node in details_nodes:
-            transaction = transaction_base.copy()
-            self.parse_transaction_details(ns, node, transaction)
+            # Start from the entry values, which the details may override
+            transaction = entry_context['transaction'].copy()
+            if with_context:
+                self._parse_transaction_details(
+                    ns, node, transaction, entry_context)
+            else:
+                self.parse_transaction_details(ns, node, transaction)
             yield transaction
 
+    def get_balance_nodes(self, ns, node):
+        """Return dictionary with the list of Bal nodes for each code.
+
+        The Bal nodes of the statement are walked once, in document order.
+        """
+        balance_nodes = {}
+        for balance_node in self.xpath(ns, node, './ns:Bal'):
+            for code_node in self.xpath(
+                    ns, balance_node, './ns:Tp/ns:CdOrPrtry/ns:Cd'):
+                nodes = balance_nodes.setdefault(code_node.text, [])
+                if not nodes or nodes[-1] is not balance_node:
+                    nodes.append(balance_node)
+        return balance_nodes
+
     def get_balance_amounts(self, ns, node):
         """Return opening and closing balance.
 
@@ -144,23 +296,20 @@ class CamtParser(models.AbstractModel):
         ITBD = InterimBalance (first ITBD is start-, second is end-balance)
         CLBD = ClosingBalance
         """
+        balance_nodes = self.get_balance_nodes(ns, node)
         start_balance_node = None
         end_balance_node = None
         for node_name in ['OPBD', 'PRCD', 'CLBD', 'ITBD']:
-            code_expr = (
-                './ns:Bal/ns:Tp/ns:CdOrPrtry/ns:Cd[text()="%s"]/../../..' %
-                node_name
-            )
-            balance_node = node.xpath(code_expr, namespaces={'ns': ns})
+            balance_node = balance_nodes.get(node_name)
             if balance_node:
                 if node_name in ['OPBD', 'PRCD']:
                     start_balance_node = balance_node[0]
                 elif node_name == 'CLBD':
                     end_balance_node = balance_node[0]
                 else:
-                    if not start_balance_node:
+                    if start_balance_node is None:
                         start_balance_node = balance_node[0]
-                    if not end_balance_node:
+                    if end_balance_node is None:
                         end_balance_node = balance_node[-1]
         return (
             self.parse_amount(ns, start_balance_node),
@@ -169,6 +318,13 @@ class CamtParser(models.AbstractModel):
 
     def parse_statement(self, ns, node):
         """Parse a single Stmt node."""
+        return self._parse_statement(ns, node)
+
+    def _parse_statement(self, ns, node, transactions=None):
+        """Parse a single Stmt node.
+
+        transactions are passed when the Ntry nodes of the statement were
+        already parsed (and removed) while reading the file."""
         result = {}
         self.add_value_from_node(
             ns, node, [
@@ -182,10 +338,11 @@ class CamtParser(models.AbstractModel):
             ns, node, './ns:Acct/ns:Ccy', result, 'currency')
         result['balance_start'], result['balance_end_real'] = (
             self.get_balance_amounts(ns, node))
-        entry_nodes = node.xpath('./ns:Ntry', namespaces={'ns': ns})
-        transactions = []
-        for entry_node in entry_nodes:
-            transactions.extend(self.parse_entry(ns, entry_node))
+        if transactions is None:
+            entry_nodes = self.xpath(ns, node, './ns:Ntry')
+            transactions = []
+            for entry_node in entry_nodes:
+                transactions.extend(self.parse_entry(ns, entry_node))
         result['transactions'] = transactions
         result['date'] = None
         if transactions:
@@ -198,47 +355,183 @@ class CamtParser(models.AbstractModel):
     def check_version(self, ns, root):
         """Validate validity of camt file."""
         # Check whether it is camt at all:
-        re_camt = re.compile(
-            r'(^urn:iso:std:iso:20022:tech:xsd:camt.'
-            r'|^ISO:camt.)'
-        )
-        if not re_camt.search(ns):
+        if not RE_CAMT.search(ns):
             raise ValueError('no camt: ' + ns)
         # Check whether version 052 ,053 or 054:
-        re_camt_version = re.compile(
-            r'(^urn:iso:std:iso:20022:tech:xsd:camt.054.'
-            r'|^urn:iso:std:iso:20022:tech:xsd:camt.053.'
-            r'|^urn:iso:std:iso:20022:tech:xsd:camt.052.'
-            r'|^ISO:camt.054.'
-            r'|^ISO:camt.053.'
-            r'|^ISO:camt.052.)'
-        )
-        if not re_camt_version.search(ns):
+        if not RE_CAMT_VERSION.search(ns):
             raise ValueError('no camt 052 or 053 or 054: ' + ns)
         # Check GrpHdr element:
         root_0_0 = root[0][0].tag[len(ns) + 2:]  # strip namespace
         if root_0_0 != 'GrpHdr':
             raise ValueError('expected GrpHdr, got: ' + root_0_0)
 
-    def parse(self, data):
-        """Parse a camt.052 or camt.053 or camt.054 file."""
+    def _get_parallel_config(self):
+        """Return number of worker processes and minimum number of statements
+        for parsing statements in parallel. Parallel parsing is disabled
+        unless the number of workers is set to more than 1."""
+        return (
+            self._get_int_param(
+                'account_bank_statement_import_camt_oca.max_workers', 0),
+            self._get_int_param(
+                'account_bank_statement_import_camt_oca.parallel_threshold',
+                20),
+        )
+
+    def _get_int_param(self, key, default):
+        """Return the integer value of a system parameter.
+
+        A malformed value raises a UserError rather than a ValueError, which
+        the import would take for a file of another format."""
+        value = self.env['ir.config_parameter'].sudo().get_param(key, default)
         try:
-            root = etree.fromstring(
-                data, parser=etree.XMLParser(recover=True))
-        except etree.XMLSyntaxError:
-            # ABNAmro is known to mix up encodings
-            root = etree.fromstring(
-                data.decode('iso-8859-15').encode('utf-8'))
+            return int(value)
+        except ValueError:
+            raise UserError(
+                _("The system parameter %s must be an integer, not %s.")
+                % (key, value))
+
+    def iterparse_statements(
+            self, source, recover=True, parse_entries=True, encoding=None):
+        """Yield (ns, node, transactions) for each statement in source.
+
+        source is read incrementally with iterparse, instead of building the
+        tree of the complete file. With parse_entries, each Ntry node is
+        parsed as soon as it is complete and then removed, and transactions
+        is the list of parsed entries. Otherwise transactions is None and
+        node still holds its Ntry nodes. Statement nodes are removed once
+        the next one is requested."""
+        root = None
+        ns = None
+        entry_tag = None
+        checked = False
+        depth = 0
+        transactions = None
+        for event, node in etree.iterparse(
+                source, events=('start', 'end'), recover=recover,
+                encoding=encoding):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = node
+                    ns = root.tag[1:root.tag.index("}")]
+                    entry_tag = '{%s}Ntry' % ns
+                elif depth == 3 and not checked:
+                    # root[0][0] (the GrpHdr) is available now
+                    self.check_version(ns, root)
+                    checked = True
+                elif depth == 3:
+                    transactions = []
+                continue
+            depth -= 1
+            if depth == 3 and transactions is not None and parse_entries \
+                    and node.tag == entry_tag:
+                transactions.extend(self.parse_entry(ns, node))
+                node.clear()
+                previous = node.getprevious()
+                while previous is not None and previous.tag == entry_tag:
+                    node.getparent().remove(previous)
+                    previous = node.getprevious()
+            elif depth == 2 and transactions is not None:
+                yield ns, node, transactions if parse_entries else None
+                transactions = None
+                node.clear()
+                while node.getprevious() is not None:
+                    del node.getparent()[0]
         if root is None:
             raise ValueError(
                 'Not a valid xml file, or not an xml file at all.')
-        ns = root.tag[1:root.tag.index("}")]
-        self.check_version(ns, root)
+        if not checked:
+            self.check_version(ns, root)
+
+    def iter_statements(
+            self, source, recover=True, max_workers=None, encoding=None):
+        """Parse the statements in source, yielding them one by one.
+
+        Unless max_workers is passed, the configured number of workers is
+        used. encoding overrides the encoding of the document."""
+        threshold = 0
+        if max_workers is None:
+            max_workers, threshold = self._get_parallel_config()
+        if max_workers > 1:
+            yield from self._iter_statements_parallel(
+                source, recover, max_workers, threshold, encoding)
+            return
+        # Overrides of parse_statement get the statements with their entries
+        with_entries = self._is_overridden('parse_statement')
+        for ns, node, transactions in self.iterparse_statements(
+                source, recover=recover, parse_entries=not with_entries,
+                encoding=encoding):
+            if with_entries:
+                yield self.parse_statement(ns, node)
+            else:
+                yield self._parse_statement(ns, node, transactions)
+
+    def _iter_statements_parallel(
+            self, source, recover, max_workers, threshold, encoding=None):
+        """Parse the statements in a pool of processes, keeping their order.
+
+        Files with fewer statements than threshold are parsed in this
+        process."""
+        items = (
+            (ns, etree.tostring(node)) for ns, node, dummy in
+            self.iterparse_statements(
+                source, recover=recover, parse_entries=False,
+                encoding=encoding))
+        head = list(itertools.islice(items, threshold))
+        if len(head) < threshold:
+            for ns, data in head:
+                yield self.parse_statement(ns, etree.fromstring(data))
+            return
+        yield from iter_in_workers(
+            self, parse_statement_in_worker, itertools.chain(head, items),
+            max_workers)
+
+    def sniff_encoding(self, data):
+        """Return encoding to parse data with, or None to let lxml decide.
+
+        Files that are declared as (or default to) UTF-8, but are not valid
+        UTF-8, are parsed as FALLBACK_ENCODING. The whole file is checked,
+        by chunks of ENCODING_CHUNK_SIZE bytes, as lxml would replace the
+        invalid characters it finds later on."""
+        if data.startswith((codecs.BOM_UTF8, codecs.BOM_UTF16_LE,
+                            codecs.BOM_UTF16_BE)):
+            return None
+        declaration = RE_XML_ENCODING.match(data[:200])
+        if declaration and declaration.group(1).lower() not in (
+                b'utf-8', b'utf8'):
+            return None
+        # Incremental, as a chunk might end within a character
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        view = memoryview(data)
+        try:
+            for start in range(0, len(data), ENCODING_CHUNK_SIZE):
+                decoder.decode(view[start:start + ENCODING_CHUNK_SIZE])
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            return FALLBACK_ENCODING
+        return None
+
+    def parse(self, data, max_workers=None):
+        """Parse a camt.052 or camt.053 or camt.054 file."""
+        encoding = self.sniff_encoding(data)
+        try:
+            parsed = list(self.iter_statements(
+                BytesIO(data), max_workers=max_workers, encoding=encoding))
+            path = encoding and 'sniffed' or 'declared'
+        except etree.XMLSyntaxError:
+            _logger.info(
+                "camt file is not valid XML, parsing it again as %s.",
+                FALLBACK_ENCODING)
+            path = 'fallback'
+            parsed = list(self.iter_statements(
+                BytesIO(data.decode(FALLBACK_ENCODING).encode('utf-8')),
+                recover=False, max_workers=max_workers))
+        encoding_path_counts[path] += 1
+        _logger.info(ENCODING_PATH_LOG, path)
         statements = []
         currency = None
         account_number = None
-        for node in root[0][1:]:
-            statement = self.parse_statement(ns, node)
+        for statement in parsed:
             if len(statement['transactions']):
                 if 'currency' in statement:
                     currency = statement.pop('currency')
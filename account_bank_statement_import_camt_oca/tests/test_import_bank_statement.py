@@ -6,11 +6,18 @@ import base64
 import difflib
 import pprint
 import tempfile
+import zipfile
+from io import BytesIO
+from lxml import etree
 
 
+from odoo.exceptions import UserError
 from odoo.tests.common import TransactionCase
 from odoo.modules.module import get_module_resource
 
+from ..models.parser import ENCODING_CHUNK_SIZE, ENCODING_PATH_LOG, \
+    encoding_path_counts
+
 
 class TestParser(TransactionCase):
     """Tests for the camt parser itself."""
@@ -62,6 +69,136 @@ class TestParser(TransactionCase):
             'test-camt053-no-ntry',
             'golden-camt053-no-ntry.pydata')
 
+    def test_iterparse_statements(self):
+        """Parsed entries are removed from the tree while reading."""
+        testfile = get_module_resource(
+            'account_bank_statement_import_camt_oca',
+            'test_files',
+            'test-camt053',
+        )
+        with open(testfile, 'rb') as data:
+            for ns, node, transactions in self.parser.iterparse_statements(
+                    BytesIO(data.read())):
+                self.assertEqual(len(transactions), 4)
+                entry_nodes = node.xpath('./ns:Ntry', namespaces={'ns': ns})
+                self.assertEqual(len(entry_nodes), 1)
+                self.assertEqual(len(entry_nodes[0]), 0)
+                self.assertTrue(node.xpath(
+                    './ns:Bal', namespaces={'ns': ns}))
+
+    def test_xpath(self):
+        """Compiled paths give the same nodes as plain xpath calls."""
+        testfile = get_module_resource(
+            'account_bank_statement_import_camt_oca',
+            'test_files',
+            'test-camt053',
+        )
+        with open(testfile, 'rb') as data:
+            for ns, node, dummy in self.parser.iterparse_statements(
+                    BytesIO(data.read()), parse_entries=False):
+                for path in ['./ns:Ntry', './ns:Acct/ns:Id/ns:IBAN']:
+                    expected = node.xpath(path, namespaces={'ns': ns})
+                    self.assertTrue(expected)
+                    self.assertEqual(
+                        self.parser.xpath(ns, node, path), expected)
+                    # Again, now from the cache
+                    self.assertEqual(
+                        self.parser.xpath(ns, node, path), expected)
+
+    def test_get_balance_amounts(self):
+        ns = 'urn:iso:std:iso:20022:tech:xsd:camt.052.001.02'
+        balance = (
+            '<Bal><Tp><CdOrPrtry><Cd>%s</Cd></CdOrPrtry></Tp>'
+            '<Amt Ccy="EUR">%s</Amt><CdtDbtInd>%s</CdtDbtInd></Bal>')
+        for balances, expected in [
+                ([('ITBD', 1, 'CRDT'), ('ITBD', 2, 'DBIT'),
+                  ('ITBD', 3, 'CRDT')], (1.0, 3.0)),
+                ([('ITBD', 1, 'CRDT'), ('CLBD', 2, 'DBIT'),
+                  ('ITBD', 3, 'CRDT')], (1.0, -2.0)),
+                ([('PRCD', 1, 'CRDT'), ('OPBD', 2, 'CRDT'),
+                  ('ITBD', 3, 'CRDT')], (1.0, 3.0)),
+                ([('OPBD', 1, 'DBIT'), ('CLBD', 2, 'CRDT')], (-1.0, 2.0)),
+                ([], (0.0, 0.0))]:
+            node = etree.fromstring('<Stmt xmlns="%s">%s</Stmt>' % (
+                ns, ''.join(balance % vals for vals in balances)))
+            self.assertEqual(
+                self.parser.get_balance_amounts(ns, node), expected)
+
+    def test_parse_entry(self):
+        ns = 'urn:iso:std:iso:20022:tech:xsd:camt.053.001.02'
+        details = (
+            '<TxDtls>%s<AmtDtls><TxAmt><Amt Ccy="EUR">%s</Amt></TxAmt>'
+            '</AmtDtls><RltdPties><Dbtr><Nm>Debtor</Nm></Dbtr>'
+            '<Cdtr><Nm>Creditor</Nm></Cdtr></RltdPties></TxDtls>')
+        node = etree.fromstring(
+            '<Ntry xmlns="%s"><Amt Ccy="EUR">3.00</Amt>'
+            '<CdtDbtInd>DBIT</CdtDbtInd><BookgDt><Dt>2014-01-05</Dt>'
+            '</BookgDt><NtryDtls><Btch><PmtInfId>BATCH</PmtInfId></Btch>'
+            '%s%s</NtryDtls></Ntry>' % (
+                ns, details % ('', '1.00'),
+                details % ('<CdtDbtInd>CRDT</CdtDbtInd>', '2.00')))
+        transactions = list(self.parser.parse_entry(ns, node))
+        self.assertEqual(
+            [(t['date'], t['ref'], t['amount'], t['partner_name'])
+             for t in transactions],
+            [('2014-01-05', 'BATCH', -1.0, 'Creditor'),
+             ('2014-01-05', 'BATCH', 2.0, 'Creditor')])
+        # Details parsed on their own find the same entry values
+        transaction = {}
+        self.parser.parse_transaction_details(
+            ns, node[3][1], transaction)
+        self.assertEqual(transaction['amount'], -1.0)
+        self.assertEqual(transaction['partner_name'], 'Creditor')
+
+    def test_parse_mixed_encoding(self):
+        """Files declared as UTF-8 but encoded otherwise are detected."""
+        testfile = get_module_resource(
+            'account_bank_statement_import_camt_oca',
+            'test_files',
+            'test-camt053',
+        )
+        with open(testfile, 'rb') as datafile:
+            data = b'<?xml version="1.0" encoding="UTF-8"?>\n' + \
+                datafile.read().replace(
+                    b'1234Test/1', 'Tést €'.encode('iso-8859-15'))
+        self.assertEqual(self.parser.sniff_encoding(data), 'iso-8859-15')
+        sniffed = encoding_path_counts['sniffed']
+        with self.assertLogs(
+                'odoo.addons.account_bank_statement_import_camt_oca',
+                level='INFO') as logs:
+            statements = self.parser.parse(data)[2]
+        self.assertIn(ENCODING_PATH_LOG % 'sniffed', logs.output[-1])
+        self.assertEqual(statements[0]['name'], 'Tést €')
+        self.assertEqual(
+            encoding_path_counts['sniffed'], sniffed + 1)
+        self.assertIsNone(self.parser.sniff_encoding(
+            data.replace(b'UTF-8', b'ISO-8859-15')))
+        # The whole file is checked, not only its start
+        declaration, content = data.split(b'\n', 1)
+        padding = b'<!--' + b' ' * ENCODING_CHUNK_SIZE + b'-->'
+        self.assertEqual(
+            self.parser.sniff_encoding(
+                declaration + b'\n' + padding + content),
+            'iso-8859-15')
+        # Characters may span two chunks
+        prefix = declaration + b'\n<!--'
+        prefix += b' ' * (ENCODING_CHUNK_SIZE - len(prefix) - 1)
+        self.assertIsNone(self.parser.sniff_encoding(
+            prefix + 'é-->'.encode('utf-8') +
+            content.replace('Tést €'.encode('iso-8859-15'), b'Test')))
+
+    def test_parse_parallel(self):
+        set_param = self.env['ir.config_parameter'].sudo().set_param
+        set_param('account_bank_statement_import_camt_oca.max_workers', '2')
+        set_param(
+            'account_bank_statement_import_camt_oca.parallel_threshold', '0')
+        self._do_parse_test(
+            'test-camt053-txdtls',
+            'golden-camt053-txdtls.pydata')
+        set_param('account_bank_statement_import_camt_oca.max_workers', 'two')
+        with self.assertRaises(UserError):
+            self.parser._get_parallel_config()
+
 
 class TestImport(TransactionCase):
     """Run test to import camt import."""
@@ -148,3 +285,46 @@ class TestImport(TransactionCase):
                 action['context']['statement_ids']
             ):
                 self.assertTrue(statement.line_ids)
+
+    def test_zip_parse_parallel(self):
+        """Test parsing zip members in worker processes."""
+        testfile = get_module_resource(
+            'account_bank_statement_import_camt_oca',
+            'test_files',
+            'test-camt053.zip',
+        )
+        wizard = self.env['account.bank.statement.import']
+        with open(testfile, 'rb') as datafile:
+            data = datafile.read()
+        serial = wizard._parse_file(data)
+        set_param = self.env['ir.config_parameter'].sudo().set_param
+        set_param('account_bank_statement_import_camt_oca.max_workers', '2')
+        set_param(
+            'account_bank_statement_import_camt_oca.parallel_threshold', '0')
+        self.assertEqual(wizard._parse_file(data), serial)
+        self.assertEqual(serial[1], 'NL77ABNA0574908765')
+        self.assertEqual(len(serial[2]), 2)
+        # An archive in the archive is parsed in parallel too, once the
+        # workers of the outer archive are done
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            zip_file.writestr('inner.zip', data)
+        self.assertEqual(wizard._parse_file(archive.getvalue()), serial)
+
+    def test_zip_several_accounts(self):
+        """Members for different accounts are not silently merged."""
+        testfile = get_module_resource(
+            'account_bank_statement_import_camt_oca',
+            'test_files',
+            'test-camt053',
+        )
+        with open(testfile, 'rb') as datafile:
+            data = datafile.read()
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            zip_file.writestr('first.xml', data)
+            zip_file.writestr('second.xml', data.replace(
+                b'NL77ABNA0574908765', b'NL46ABNA0499998748'))
+        with self.assertRaises(UserError):
+            self.env['account.bank.statement.import']._parse_file(
+                archive.getvalue())
@@ -13,6 +13,7 @@
         'account',
     ],
     'data': [
+        'wizards/account_statement_line_match_view.xml',
         'wizards/account_statement_line_create_view.xml',
         'views/account_bank_statement_view.xml',
     ],
@@ -1,12 +1,50 @@
 # Copyright 2017 Tecnativa - Luis M. Ontalba
 # License AGPL-3 - See http://www.gnu.org/licenses/agpl-3.0.html
 
-from odoo import api, models
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+
+# Number of statement lines created before their computed fields are updated
+STATEMENT_LINE_CHUNK_SIZE = 500
+# Fields of the move lines read by _prepare_statement_line_vals
+STATEMENT_LINE_FIELDS = [
+    'name', 'debit', 'credit', 'partner_id', 'ref', 'date_maturity',
+    'amount_currency', 'currency_id']
+# States of the payments whose move lines are not proposed in statements
+PENDING_PAYMENT_STATES = ('draft', 'posted', 'sent')
 
 
 class AccountMoveLine(models.Model):
     _inherit = 'account.move.line'
 
+    in_pending_payment = fields.Boolean(
+        compute='_compute_in_pending_payment',
+        search='_search_in_pending_payment',
+        help="The line belongs to a payment that is neither reconciled nor "
+             "cancelled.")
+
+    @api.depends('payment_id.state')
+    def _compute_in_pending_payment(self):
+        for mline in self:
+            mline.in_pending_payment = (
+                mline.payment_id.state in PENDING_PAYMENT_STATES)
+
+    @api.model
+    def _search_in_pending_payment(self, operator, value):
+        """Search the lines of pending payments with a subquery on the
+        payments, so that the domain does not list any ids."""
+        if operator not in ('=', '!='):
+            raise UserError(_("Operation not supported"))
+        query = (
+            'SELECT line.id FROM account_move_line line '
+            'JOIN account_payment payment ON payment.id = line.payment_id '
+            'WHERE payment.state IN %s')
+        if (operator == '=') == bool(value):
+            operator = 'inselect'
+        else:
+            operator = 'not inselect'
+        return [('id', operator, (query, [PENDING_PAYMENT_STATES]))]
+
     @api.multi
     def _prepare_statement_line_vals(self, statement):
         self.ensure_one()
@@ -28,9 +66,24 @@ class AccountMoveLine(models.Model):
             }
         return vals
 
+    @api.multi
+    def _prepare_statement_lines_vals(self, statement):
+        """Return the values of the statement lines of all move lines."""
+        # Read the fields of all move lines at once, not line by line
+        self.read(STATEMENT_LINE_FIELDS, load='_classic_write')
+        return [
+            mline._prepare_statement_line_vals(statement) for mline in self
+        ]
+
     @api.multi
     def create_statement_line_from_move_line(self, statement):
         abslo = self.env['account.bank.statement.line']
-        for mline in self:
-            abslo.create(mline._prepare_statement_line_vals(statement))
+        vals_list = self._prepare_statement_lines_vals(statement)
+        for i in range(0, len(vals_list), STATEMENT_LINE_CHUNK_SIZE):
+            # Computed fields, like the balance of the statement, are
+            # updated once per chunk rather than once per line
+            with self.env.norecompute():
+                for vals in vals_list[i:i + STATEMENT_LINE_CHUNK_SIZE]:
+                    abslo.create(vals)
+            abslo.recompute()
         return
@@ -70,3 +70,138 @@ class TestAccountBankStatementImportMoveLine(common.SavepointCase):
         wizard.create_statement_lines()
         line = self.statement.line_ids[0]
         self.assertEqual(line.amount, self.invoice.amount_total)
+
+    def test_payment_lines_excluded(self):
+        payment = self.env['account.payment'].create({
+            'payment_type': 'inbound',
+            'partner_type': 'customer',
+            'partner_id': self.partner.id,
+            'amount': 50.0,
+            'journal_id': self.journal.id,
+            'payment_method_id': self.env.ref(
+                'account.account_payment_method_manual_in').id,
+        })
+        payment.post()
+        self.assertTrue(payment.move_line_ids)
+        wizard = self.env['account.statement.line.create'].with_context(
+            active_model='account.bank.statement',
+            active_id=self.statement.id,
+        ).create({
+            'statement_id': self.statement.id,
+            'partner_id': self.partner.id,
+            'allow_blocked': True,
+            'date_type': 'move',
+            'move_date': fields.Date.today(),
+            'invoice': False,
+        })
+        wizard.populate()
+        self.assertFalse(wizard.move_line_ids & payment.move_line_ids)
+        self.assertTrue(all(
+            payment.move_line_ids.mapped('in_pending_payment')))
+        # Neither the domain nor its query list the ids of payments or lines
+        domain = wizard._get_move_line_domain()
+        where_params = self.env['account.move.line']._where_calc(
+            domain).get_sql()[2]
+        for value in [leaf[2] for leaf in domain if isinstance(leaf, (
+                list, tuple))] + where_params:
+            if isinstance(value, (list, tuple)):
+                self.assertFalse(
+                    [item for item in value if isinstance(item, int)])
+
+    def test_populate_pages(self):
+        self.invoice.action_invoice_open()
+        wizard = self.env['account.statement.line.create'].with_context(
+            active_model='account.bank.statement',
+            active_id=self.statement.id,
+        ).create({
+            'statement_id': self.statement.id,
+            'partner_id': self.partner.id,
+            'journal_ids': [(4, self.journal.id)],
+            'allow_blocked': True,
+            'date_type': 'move',
+            'move_date': fields.Date.today(),
+            'invoice': False,
+            'paginate': True,
+            'page_size': 1,
+        })
+        self.assertEqual(
+            wizard._get_move_line_domain(),
+            wizard._prepare_move_line_domain())
+        self.assertEqual(wizard.move_line_count, 2)
+        wizard.populate()
+        first_line = wizard.move_line_ids
+        self.assertEqual(len(first_line), 1)
+        wizard.next_page()
+        self.assertEqual(wizard.page, 2)
+        self.assertEqual(len(wizard.move_line_ids), 1)
+        self.assertNotEqual(wizard.move_line_ids, first_line)
+        # There is no third page
+        wizard.next_page()
+        self.assertEqual(wizard.page, 2)
+        wizard.previous_page()
+        self.assertEqual(wizard.move_line_ids, first_line)
+        # The domain follows the filters
+        wizard.invoice = True
+        self.assertIn(('invoice_id', '!=', False),
+                      wizard._get_move_line_domain())
+
+    def test_create_statement_lines(self):
+        self.invoice.action_invoice_open()
+        move_lines = self.invoice.move_id.line_ids
+        move_lines.create_statement_line_from_move_line(self.statement)
+        self.assertEqual(len(self.statement.line_ids), len(move_lines))
+        self.assertEqual(
+            sorted(self.statement.line_ids.mapped('amount')),
+            sorted(line.debit or -line.credit for line in move_lines))
+        # The balance of the statement is computed once the lines are created
+        self.assertAlmostEqual(
+            self.statement.balance_end,
+            self.statement.balance_start + sum(
+                self.statement.line_ids.mapped('amount')))
+
+    def test_propose_matches(self):
+        self.invoice.action_invoice_open()
+        statement_lines = self.env['account.bank.statement.line']
+        for vals in [
+                {'name': 'Payment %s' % self.invoice.number},
+                {'name': 'Payment', 'partner_id': self.partner.id},
+                {'name': 'Unknown'},
+                # Shares a word with the label of the move line only
+                {'name': 'Invoice of the month', 'amount': 42.0}]:
+            vals.setdefault('amount', self.invoice.amount_total)
+            vals.update({
+                'statement_id': self.statement.id,
+                'date': fields.Date.today(),
+            })
+            statement_lines |= statement_lines.create(vals)
+        wizard = self.env['account.statement.line.create'].with_context(
+            active_model='account.bank.statement',
+            active_id=self.statement.id,
+        ).create({
+            'statement_id': self.statement.id,
+            'journal_ids': [(4, self.journal.id)],
+            'date_type': 'move',
+            'move_date': fields.Date.today(),
+        })
+        action = wizard.propose_matches()
+        matches = self.env['account.statement.line.match'].search(
+            action['domain'])
+        self.assertEqual(matches.mapped('statement_line_id'), statement_lines)
+        receivable_line = self.invoice.move_id.line_ids.filtered(
+            lambda line: line.account_id == self.invoice.account_id)
+        match = matches.filtered(
+            lambda m: m.statement_line_id == statement_lines[0])
+        self.assertEqual(match.match_type, 'reference')
+        self.assertEqual(match.move_line_id, receivable_line)
+        # The move line is only proposed once
+        self.assertFalse(matches.filtered(
+            lambda m: m.statement_line_id == statement_lines[1]).move_line_id)
+        self.assertEqual(matches.filtered(
+            lambda m: m.statement_line_id == statement_lines[2]).match_type,
+            'none')
+        self.assertIn('Invoice', receivable_line.name)
+        self.assertEqual(matches.filtered(
+            lambda m: m.statement_line_id == statement_lines[3]).match_type,
+            'none')
+        # Nothing is reconciled
+        self.assertFalse(statement_lines.mapped('journal_entry_ids'))
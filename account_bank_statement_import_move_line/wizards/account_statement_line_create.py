@@ -2,6 +2,13 @@
 # License AGPL-3 - See http://www.gnu.org/licenses/agpl-3.0.html
 
 from odoo import _, api, fields, models
+from odoo.exceptions import ValidationError
+from odoo.tools.safe_eval import safe_eval
+
+# Fields of the wizard that filter the move lines
+MOVE_LINE_FILTER_FIELDS = (
+    'date_type', 'move_date', 'due_date', 'journal_ids', 'invoice',
+    'target_move', 'allow_blocked', 'partner_id')
 
 
 class AccountStatementLineCreate(models.TransientModel):
@@ -33,6 +40,20 @@ class AccountStatementLineCreate(models.TransientModel):
                             default=fields.Date.context_today)
     move_line_ids = fields.Many2many(
         'account.move.line', string='Move Lines')
+    move_line_domain = fields.Char(
+        compute='_compute_move_line_domain', store=True,
+        help="Domain of the move lines matching the filters, kept until the "
+             "filters change.")
+    move_line_count = fields.Integer(
+        compute='_compute_move_line_count', string='Matching Move Lines')
+    paginate = fields.Boolean(
+        string='Load by Pages',
+        help="Add the matching move lines one page at a time.")
+    page = fields.Integer(default=1)
+    page_size = fields.Integer(default=80)
+    match_ids = fields.One2many(
+        'account.statement.line.match', 'wizard_id',
+        string='Proposed Matches')
 
     @api.model
     def default_get(self, field_list):
@@ -61,8 +82,7 @@ class AccountStatementLineCreate(models.TransientModel):
         if self.journal_ids:
             domain += [('journal_id', 'in', self.journal_ids.ids)]
         else:
-            journals = self.env['account.journal'].search([])
-            domain += [('journal_id', 'in', journals.ids)]
+            domain += [('journal_id.active', '=', True)]
         if self.partner_id:
             domain += [('partner_id', '=', self.partner_id.id)]
         if self.target_move == 'posted':
@@ -78,18 +98,49 @@ class AccountStatementLineCreate(models.TransientModel):
             domain.append(('date', '<=', self.move_date))
         if self.invoice:
             domain.append(('invoice_id', '!=', False))
-        paylines = self.env['account.payment'].search([
-            ('state', 'in', ('draft', 'posted', 'sent')),
-            ('move_line_ids', '!=', False)])
-        if paylines:
-            move_in_payment_ids = paylines.mapped('move_line_ids.id')
-            domain += [('id', 'not in', move_in_payment_ids)]
+        # Exclude the lines of pending payments with a subquery, so that the
+        # domain does not grow with the number of payments
+        domain.append(('in_pending_payment', '=', False))
         return domain
 
+    @api.depends(*MOVE_LINE_FILTER_FIELDS)
+    def _compute_move_line_domain(self):
+        for wizard in self:
+            wizard.move_line_domain = str(
+                wizard._prepare_move_line_domain())
+
+    @api.depends('move_line_domain', 'paginate')
+    def _compute_move_line_count(self):
+        """Count the matching move lines, only needed to load pages."""
+        for wizard in self:
+            wizard.move_line_count = wizard.paginate and self.env[
+                'account.move.line'].search_count(
+                    wizard._get_move_line_domain())
+
+    @api.constrains('paginate', 'page', 'page_size')
+    def _check_page(self):
+        for wizard in self.filtered('paginate'):
+            if wizard.page < 1 or wizard.page_size < 1:
+                raise ValidationError(_(
+                    "The page and the page size must be positive."))
+
+    @api.multi
+    def _get_move_line_domain(self):
+        """Return the domain of the move lines matching the filters."""
+        self.ensure_one()
+        if not self.move_line_domain:
+            return self._prepare_move_line_domain()
+        return safe_eval(self.move_line_domain)
+
     @api.multi
     def populate(self):
-        domain = self._prepare_move_line_domain()
-        lines = self.env['account.move.line'].search(domain)
+        domain = self._get_move_line_domain()
+        if self.paginate:
+            lines = self.env['account.move.line'].search(
+                domain, offset=(self.page - 1) * self.page_size,
+                limit=self.page_size)
+        else:
+            lines = self.env['account.move.line'].search(domain)
         self.move_line_ids = lines
         action = {
             'name': _('Select Move Lines to Create Statement'),
@@ -102,11 +153,46 @@ class AccountStatementLineCreate(models.TransientModel):
         }
         return action
 
-    @api.onchange(
-        'date_type', 'move_date', 'due_date', 'journal_ids', 'invoice',
-        'target_move', 'allow_blocked', 'partner_id')
+    @api.multi
+    def propose_matches(self):
+        """Propose a matching move line for each open statement line.
+
+        The move lines matching the filters are the candidates. They are
+        loaded once and nothing is reconciled: the proposals are shown for
+        review."""
+        self.ensure_one()
+        match_model = self.env['account.statement.line.match']
+        self.match_ids.unlink()
+        move_lines = self.env['account.move.line'].search(
+            self._get_move_line_domain())
+        for vals in match_model._prepare_match_vals(
+                self.statement_id, move_lines):
+            vals['wizard_id'] = self.id
+            match_model.create(vals)
+        action = self.env.ref(
+            'account_bank_statement_import_move_line.'
+            'account_statement_line_match_action').read()[0]
+        action['domain'] = [('wizard_id', '=', self.id)]
+        return action
+
+    @api.multi
+    def next_page(self):
+        self.ensure_one()
+        if self.page * self.page_size < self.move_line_count:
+            self.page += 1
+        return self.populate()
+
+    @api.multi
+    def previous_page(self):
+        self.ensure_one()
+        if self.page > 1:
+            self.page -= 1
+        return self.populate()
+
+    @api.onchange(*MOVE_LINE_FILTER_FIELDS)
     def move_line_filters_change(self):
-        domain = self._prepare_move_line_domain()
+        self.page = 1
+        domain = self._get_move_line_domain()
         res = {'domain': {'move_line_ids': domain}}
         return res
 
@@ -0,0 +1,181 @@
+# License AGPL-3 - See http://www.gnu.org/licenses/agpl-3.0.html
+
+import collections
+import re
+
+from odoo import api, fields, models
+from odoo.tools import float_repr
+
+RE_REFERENCE_SEPARATOR = re.compile(r'[\W_]+')
+# Shorter references are too common to identify a move line
+REFERENCE_MIN_LENGTH = 3
+
+
+def normalize_reference(value):
+    """Return the key of a reference, without separators nor case."""
+    if not value:
+        return ''
+    return RE_REFERENCE_SEPARATOR.sub('', value).upper()
+
+
+def get_reference_keys(*values, split_words=False):
+    """Return the keys of the references, in order.
+
+    With split_words, the keys of the words of the references are added,
+    to find a reference among other words."""
+    keys = []
+    for value in values:
+        if not value:
+            continue
+        value_keys = [normalize_reference(value)]
+        if split_words:
+            value_keys += [normalize_reference(word) for word in value.split()]
+        for key in value_keys:
+            if len(key) >= REFERENCE_MIN_LENGTH and key not in keys:
+                keys.append(key)
+    return keys
+
+
+class AccountStatementLineMatch(models.TransientModel):
+    _name = 'account.statement.line.match'
+    _description = 'Proposed match of a statement line with a move line'
+    _order = 'statement_line_id'
+
+    wizard_id = fields.Many2one(
+        'account.statement.line.create', string='Wizard',
+        ondelete='cascade')
+    statement_line_id = fields.Many2one(
+        'account.bank.statement.line', string='Statement Line',
+        required=True)
+    date = fields.Date(related='statement_line_id.date', readonly=True)
+    name = fields.Char(related='statement_line_id.name', readonly=True)
+    ref = fields.Char(related='statement_line_id.ref', readonly=True)
+    partner_id = fields.Many2one(
+        related='statement_line_id.partner_id', readonly=True)
+    amount = fields.Monetary(
+        related='statement_line_id.amount', readonly=True)
+    currency_id = fields.Many2one(
+        related='statement_line_id.journal_currency_id', readonly=True)
+    move_line_id = fields.Many2one(
+        'account.move.line', string='Proposed Move Line')
+    move_line_partner_id = fields.Many2one(
+        related='move_line_id.partner_id', string='Move Line Partner',
+        readonly=True)
+    amount_residual = fields.Monetary(
+        related='move_line_id.amount_residual', readonly=True,
+        currency_field='company_currency_id')
+    company_currency_id = fields.Many2one(
+        related='move_line_id.company_currency_id', readonly=True)
+    match_type = fields.Selection([
+        ('reference', 'Reference'),
+        ('amount_partner', 'Amount and Partner'),
+        ('ambiguous', 'Several Move Lines'),
+        ('none', 'No Match'),
+        ], string='Match', required=True)
+    candidate_count = fields.Integer(
+        string='Candidates',
+        help="Number of move lines the statement line could match.")
+
+    @api.model
+    def _get_amount_key(self, amount, currency):
+        return float_repr(currency.round(amount), currency.decimal_places)
+
+    @api.model
+    def _get_move_line_amount(self, move_line, currency):
+        """Return the residual amount of a move line in currency, or None."""
+        if move_line.currency_id:
+            if move_line.currency_id == currency:
+                return move_line.amount_residual_currency
+            return None
+        if move_line.company_currency_id == currency:
+            return move_line.amount_residual
+        return None
+
+    @api.model
+    def _get_move_line_references(self, move_line):
+        """Return the keys of the whole references of a move line.
+
+        Their words and the label of the line are left out: words they
+        share with the statement lines are too generic to be references."""
+        return get_reference_keys(
+            move_line.ref, move_line.move_id.name,
+            move_line.invoice_id.number, move_line.invoice_id.reference)
+
+    @api.model
+    def _get_statement_line_references(self, statement_line):
+        """Return the keys of the references of a statement line and of
+        their words, as banks add other words around the references."""
+        return get_reference_keys(
+            statement_line.ref, statement_line.name, split_words=True)
+
+    @api.model
+    def _get_match_indexes(self, move_lines, currency):
+        """Index the move lines by reference and by amount and partner.
+
+        Return the two indexes and the amount key of each move line."""
+        by_reference = collections.defaultdict(list)
+        by_amount_partner = collections.defaultdict(list)
+        amount_keys = {}
+        for move_line in move_lines:
+            for key in self._get_move_line_references(move_line):
+                by_reference[key].append(move_line)
+            amount = self._get_move_line_amount(move_line, currency)
+            if amount is None:
+                continue
+            amount_keys[move_line] = self._get_amount_key(amount, currency)
+            partner = move_line.partner_id.commercial_partner_id
+            if partner:
+                by_amount_partner[
+                    (amount_keys[move_line], partner.id)].append(move_line)
+        return by_reference, by_amount_partner, amount_keys
+
+    @api.model
+    def _prepare_match_vals(self, statement, move_lines):
+        """Return the values of the proposed match of each open line.
+
+        The move lines are indexed once, then each statement line is looked
+        up in the indexes. A move line is proposed for one statement line
+        at most. Matches by reference come first: if several move lines
+        share the reference, the ones of the same amount are preferred.
+        Then, the move lines of the same amount and partner are used."""
+        currency = statement.currency_id
+        by_reference, by_amount_partner, amount_keys = (
+            self._get_match_indexes(move_lines, currency))
+        used = set()
+        vals_list = []
+        for statement_line in statement.line_ids:
+            if statement_line.journal_entry_ids:
+                continue
+            amount_key = self._get_amount_key(
+                statement_line.amount, currency)
+            vals = {
+                'statement_line_id': statement_line.id,
+                'match_type': 'none',
+            }
+            candidates = []
+            for key in self._get_statement_line_references(statement_line):
+                for move_line in by_reference.get(key, []):
+                    if move_line not in used and move_line not in candidates:
+                        candidates.append(move_line)
+            candidates = [
+                move_line for move_line in candidates
+                if amount_keys.get(move_line) == amount_key
+            ] or candidates
+            match_type = 'reference'
+            partner = statement_line.partner_id.commercial_partner_id
+            if not candidates and partner:
+                candidates = [
+                    move_line for move_line in by_amount_partner.get(
+                        (amount_key, partner.id), [])
+                    if move_line not in used
+                ]
+                match_type = 'amount_partner'
+            vals['candidate_count'] = len(candidates)
+            if len(candidates) == 1:
+                used.add(candidates[0])
+                vals.update(
+                    move_line_id=candidates[0].id, match_type=match_type)
+            elif candidates:
+                vals['match_type'] = 'ambiguous'
+            vals_list.append(vals)
+        return vals_list
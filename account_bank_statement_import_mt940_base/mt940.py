@@ -2,9 +2,15 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 """Generic parser for MT940 files, base for customized versions per bank."""
 
+import codecs
+import collections
+import copy
+import itertools
 import re
 import logging
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from io import BytesIO
 
 
 def str2amount(sign, amount_str):
@@ -86,6 +92,40 @@ def handle_common_subfields(transaction, subfields):
         transaction['ref'] = ''.join(subfields[transaction['ref']])
 
 
+def parse_statement_in_worker(parser, match, header_lines):
+    """Parse a single statement with a copy of parser, in a worker process.
+
+    Return the parser state that is merged back after parsing."""
+    parser.parse_statement(match, header_lines=header_lines)
+    return parser.currency_code, parser.account_number, parser.statements
+
+
+class CompiledRegex(object):
+    """Regex attribute that also keeps the compiled pattern.
+
+    The pattern is assigned as a string, like subclasses of MT940 do in their
+    __init__. The compiled pattern is then available as <name>_compiled. Each
+    pattern is compiled only once per class."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj.__dict__.get(self.name)
+
+    def __set__(self, obj, value):
+        cls = type(obj)
+        if '_regex_cache' not in cls.__dict__:
+            cls._regex_cache = {}
+        compiled = cls._regex_cache.get(value)
+        if compiled is None:
+            compiled = cls._regex_cache[value] = re.compile(value)
+        obj.__dict__[self.name] = value
+        obj.__dict__[self.name + '_compiled'] = compiled
+
+
 class MT940(object):
     """Inherit this class in your account_banking.parsers.models.parser,
     define functions to handle the tags you need to handle and adjust static
@@ -98,6 +138,10 @@ class MT940(object):
     without ':XX:') and are supposed to write into self.current_transaction
     """
 
+    header_regex = CompiledRegex('header_regex')
+    footer_regex = CompiledRegex('footer_regex')
+    tag_regex = CompiledRegex('tag_regex')
+
     def __init__(self):
         """Initialize parser - override at least header_regex.
 
@@ -107,6 +151,11 @@ class MT940(object):
         self.header_regex = '^0000 01INGBNL2AXXXX|^{1'  # Start of header
         self.footer_regex = '^-}$|^-XXX$'  # Stop processing on seeing this
         self.tag_regex = '^:[0-9]{2}[A-Z]*:'  # Start of new tag
+        self.read_size = 64 * 1024  # Bytes to read at once when streaming
+        # Number of processes parsing statements in parallel, 0 for serial
+        self.max_workers = 0
+        # Files with fewer statements than this are always parsed serially
+        self.parallel_threshold = 50
         self.current_statement = None
         self.current_transaction = None
         self.statements = []
@@ -115,7 +164,7 @@ class MT940(object):
 
     def is_mt940(self, line):
         """determine if a line is the header of a statement"""
-        if not bool(re.match(self.header_regex, line)):
+        if not self.header_regex_compiled.match(line):
             raise ValueError(
                 'File starting with %s does not seem to be a'
                 ' valid %s MT940 format bank statement.' %
@@ -132,68 +181,277 @@ class MT940(object):
             )
 
     def pre_process_data(self, data):
-        matches = []
-        self.is_mt940(line=data)
-        data = data.replace(
-            '-}', '}').replace('}{', '}\r\n{').replace('\r\n', '\n')
-        if data.startswith(':940:'):
-            for statement in data.replace(':940:', '').split(':20:'):
-                match = '{4:\n:20:' + statement + '}'
-                matches.append(match)
+        return list(self.iter_matches([data]))
+
+    def _iter_text(self, fileobj):
+        """Yield decoded chunks of text read from fileobj."""
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        while True:
+            chunk = fileobj.read(self.read_size)
+            if not chunk:
+                break
+            if isinstance(chunk, bytes):
+                chunk = decoder.decode(chunk)
+            if chunk:
+                yield chunk
+        chunk = decoder.decode(b'', final=True)
+        if chunk:
+            yield chunk
+
+    def _iter_replaced(self, chunks, replacements, hold):
+        """Apply replacements to a stream of text chunks.
+
+        hold(text) returns the number of trailing characters that might be
+        the start of a replaced sequence. These are kept back until the next
+        chunk arrives, so the result is the same as when the replacements
+        are applied to the complete text at once."""
+        carry = ''
+        for chunk in chunks:
+            text = carry + chunk
+            size = len(text) - hold(text)
+            text, carry = text[:size], text[size:]
+            for old, new in replacements:
+                text = text.replace(old, new)
+            if text:
+                yield text
+        for old, new in replacements:
+            carry = carry.replace(old, new)
+        if carry:
+            yield carry
+
+    def _iter_940_matches(self, chunks):
+        """Split data without {4: blocks on the :20: tags."""
+        chunks = self._iter_replaced(
+            chunks, [(':940:', '')],
+            lambda text: max(
+                [size for size in range(1, 5)
+                 if text.endswith(':940:'[:size])] or [0]))
+        buf = ''
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is None:
+                yield '{4:\n:20:' + buf + '}'
+                break
+            buf += chunk
+            # Only search the part of buf that might hold a new :20:
+            pos = buf.find(':20:', max(len(buf) - len(chunk) - 3, 0))
+            while pos >= 0:
+                yield '{4:\n:20:' + buf[:pos] + '}'
+                buf = buf[pos + 4:]
+                pos = buf.find(':20:')
+
+    def _iter_block_matches(self, chunks):
+        """Yield every {4:...} block, without nested braces."""
+        brace_re = re.compile(r'[{}]')
+        buf = ''
+        pos = 0
+        for chunk in chunks:
+            buf += chunk
+            while True:
+                start = buf.find('{4:', pos)
+                if start < 0:
+                    # Keep what might be the start of the next block
+                    buf = buf[max(pos, len(buf) - 2):]
+                    pos = 0
+                    break
+                brace = brace_re.search(buf, start + 3)
+                if not brace:
+                    buf = buf[start:]
+                    pos = 0
+                    break
+                end = brace.start()
+                if buf[end] == '}' and end > start + 3:
+                    yield buf[start:end + 1]
+                    pos = end + 1
+                else:
+                    pos = start + 1
+
+    def iter_matches(self, fileobj):
+        """Yield the text of the statements in fileobj one by one.
+
+        This is the streaming counterpart of pre_process_data. fileobj is
+        either a file-like object or an iterable of text chunks. Only the
+        statement that is being read is kept in memory."""
+        if hasattr(fileobj, 'read'):
+            text = self._iter_text(fileobj)
         else:
-            tag_re = re.compile(
-                r'(\{4:[^{}]+\})',
-                re.MULTILINE)
-            matches = tag_re.findall(data)
-        return matches
+            text = iter(fileobj)
+        # The header is checked against (at least) the complete first line
+        first = ''
+        for chunk in text:
+            first += chunk
+            if '\n' in chunk:
+                break
+        self.is_mt940(line=first)
+        chunks = self._iter_replaced(
+            itertools.chain([first], text),
+            [('-}', '}'), ('}{', '}\r\n{'), ('\r\n', '\n')],
+            lambda chunk: len(chunk) - len(chunk.rstrip('-}\r')))
+        head = ''
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= 5:
+                break
+        chunks = itertools.chain([head], chunks)
+        if head.startswith(':940:'):
+            return self._iter_940_matches(chunks)
+        return self._iter_block_matches(chunks)
+
+    def iter_lines(self, match):
+        """Yield the lines of a statement, without its first and last line.
+
+        The lines are found by position, so match is not copied as a whole.
+        """
+        start = match.find('\n') + 1
+        end = match.rfind('\n')
+        if start > end:
+            yield ''
+            return
+        while True:
+            pos = match.find('\n', start, end)
+            if pos < 0:
+                yield match[start:end]
+                return
+            yield match[start:pos]
+            start = pos + 1
+
+    def iter_records(self, iterator, header_lines=None):
+        """Yield (tag, data) for each record in the lines from iterator.
+
+        Unless add_record_line is overridden, the lines of a record are
+        collected in a list and joined only once the record is complete.
+        Header and footer lines are handled while reading."""
+        line = None
+        tag_match = None
+        # Overrides of add_record_line get and return the record as a string
+        join_lines = (
+            type(self).add_record_line is not MT940.add_record_line)
+        record_line = []
+        while True:
+            try:
+                if not self.current_statement:
+                    self.handle_header(line, iterator,
+                                       header_lines=header_lines)
+                line = next(iterator)
+            except StopIteration:
+                break
+            new_match = line and self.tag_regex_compiled.match(line)
+            is_footer = self.is_footer(line)
+            if not new_match and not is_footer:
+                if join_lines:
+                    record_line = self.add_record_line(
+                        line, ''.join(record_line))
+                    record_line = [record_line] if record_line else []
+                else:
+                    record_line.append(line)
+                continue
+            if record_line:
+                record = self._get_record(tag_match, record_line)
+                if record:
+                    yield record
+            tag_match = None
+            record_line = []
+            if is_footer:
+                self.handle_footer(line, iterator)
+                continue
+            tag_match = new_match
+            record_line = [line]
+        if self.current_statement and record_line:
+            record = self._get_record(tag_match, record_line)
+            if record:
+                yield record
+
+    def _get_record(self, tag_match, record_line):
+        """Return (tag, data) for the lines of a record."""
+        record = ''.join(record_line)
+        if not tag_match:
+            # Lines without a preceding tag
+            return record and (None, record)
+        return tag_match.group(0).strip(':'), record[tag_match.end():]
+
+    def parse_statement(self, match, header_lines=None):
+        """Parse the text of a single statement."""
+        self.is_mt940_statement(line=match)
+        for tag, data in self.iter_records(
+                self.iter_lines(match), header_lines=header_lines):
+            self.handle_tag(tag, data)
+        if self.current_statement:
+            self.statements.append(self.current_statement)
+            self.current_statement = None
+
+    def iter_statements(self, fileobj, header_lines=None):
+        """Parse mt940 statements from fileobj, yielding them one by one.
+
+        fileobj is read incrementally, so memory use is bounded by the
+        largest statement in the file instead of by the file size. The
+        yielded statements are not kept in self.statements."""
+        matches = self.iter_matches(fileobj)
+        if self.max_workers > 1:
+            head = list(itertools.islice(matches, self.parallel_threshold))
+            matches = itertools.chain(head, matches)
+            if len(head) >= self.parallel_threshold:
+                yield from self._iter_statements_parallel(
+                    matches, header_lines)
+                return
+        for match in matches:
+            done = len(self.statements)
+            self.parse_statement(match, header_lines=header_lines)
+            for statement in self.statements[done:]:
+                yield statement
+            del self.statements[done:]
+
+    def _iter_statements_parallel(self, matches, header_lines):
+        """Parse statements in a pool of self.max_workers processes.
+
+        Every statement is parsed by a fresh copy of the parser, so this
+        requires statements that do not depend on each other, for instance
+        because each has its own :25: tag. The results are yielded in the
+        order of the file, and at most two statements per worker are queued
+        at any time."""
+        template = copy.copy(self)
+        template.statements = []
+        template.current_statement = None
+        template.current_transaction = None
+        pending = collections.deque()
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            for match in matches:
+                pending.append(executor.submit(
+                    parse_statement_in_worker, template, match, header_lines))
+                if len(pending) >= 2 * self.max_workers:
+                    yield from self._merge_worker_result(pending.popleft())
+            while pending:
+                yield from self._merge_worker_result(pending.popleft())
+
+    def _merge_worker_result(self, future):
+        """Take over parser state from a worker and return its statements."""
+        currency_code, account_number, statements = future.result()
+        if not self.currency_code:
+            self.currency_code = currency_code
+        if account_number:
+            self.account_number = account_number
+        return statements
 
     def parse(self, data, header_lines=None):
         """Parse mt940 bank statement file contents."""
-        data = data.decode()
-        matches = self.pre_process_data(data)
-        for match in matches:
-            self.is_mt940_statement(line=match)
-            iterator = '\n'.join(
-                match.split('\n')[1:-1]).split('\n').__iter__()
-            line = None
-            record_line = ''
-            try:
-                while True:
-                    if not self.current_statement:
-                        self.handle_header(line, iterator,
-                                           header_lines=header_lines)
-                    line = next(iterator)
-                    if not self.is_tag(line) and not self.is_footer(line):
-                        record_line = self.add_record_line(line, record_line)
-                        continue
-                    if record_line:
-                        self.handle_record(record_line)
-                    if self.is_footer(line):
-                        self.handle_footer(line, iterator)
-                        record_line = ''
-                        continue
-                    record_line = line
-            except StopIteration:
-                pass
-            if self.current_statement:
-                if record_line:
-                    self.handle_record(record_line)
-                    record_line = ''
-                self.statements.append(self.current_statement)
-                self.current_statement = None
+        statements = list(
+            self.iter_statements(BytesIO(data), header_lines=header_lines))
+        self.statements.extend(statements)
         return self.currency_code, self.account_number, self.statements
 
     def add_record_line(self, line, record_line):
+        """Return the record being read with a continuation line added.
+
+        record_line is the record so far, starting with the tag line.
+        Override to, for instance, insert separators."""
         record_line += line
         return record_line
 
     def is_footer(self, line):
         """determine if a line is the footer of a statement"""
-        return line and bool(re.match(self.footer_regex, line))
+        return line and bool(self.footer_regex_compiled.match(line))
 
     def is_tag(self, line):
         """determine if a line has a tag"""
-        return line and bool(re.match(self.tag_regex, line))
+        return line and bool(self.tag_regex_compiled.match(line))
 
     def handle_header(self, dummy_line, iterator, header_lines=None):
         """skip header lines, create current statement"""
@@ -216,14 +474,31 @@ class MT940(object):
 
     def handle_record(self, line):
         """find a function to handle the record represented by line"""
-        tag_match = re.match(self.tag_regex, line)
-        tag = tag_match.group(0).strip(':')
-        if not hasattr(self, 'handle_tag_%s' % tag):  # pragma: no cover
+        tag_match = self.tag_regex_compiled.match(line)
+        self.handle_tag(
+            tag_match.group(0).strip(':'), line[tag_match.end():])
+
+    def handle_tag(self, tag, data):
+        """call the handle_tag_* function for tag with the record data"""
+        handler = self.get_tag_handlers().get(tag)
+        if not handler:  # pragma: no cover
             logging.error('Unknown tag %s', tag)
-            logging.error(line)
+            logging.error(data)
             return
-        handler = getattr(self, 'handle_tag_%s' % tag)
-        handler(line[tag_match.end():])
+        handler(self, data)
+
+    @classmethod
+    def get_tag_handlers(cls):
+        """Return dictionary mapping tags to their handle_tag_* method.
+
+        The dictionary is built once per class, so handlers defined or
+        overridden in subclasses are included."""
+        if '_tag_handlers' not in cls.__dict__:
+            cls._tag_handlers = {
+                name[len('handle_tag_'):]: getattr(cls, name)
+                for name in dir(cls) if name.startswith('handle_tag_')
+            }
+        return cls._tag_handlers
 
     def handle_tag_20(self, data):
         """Contains unique ? message ID"""
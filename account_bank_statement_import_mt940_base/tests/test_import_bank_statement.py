@@ -2,12 +2,32 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
 import base64
+from io import BytesIO
 from mock import patch
 from odoo.tests.common import TransactionCase
 from odoo.modules.module import get_module_resource
 from ..mt940 import MT940, get_subfields, handle_common_subfields
 
 
+class MT940Rabo(MT940):
+    """Bank specific parser, as implemented in other modules."""
+
+    def __init__(self):
+        super(MT940Rabo, self).__init__()
+        self.header_regex = '^:940:'
+        self.header_lines = 1
+
+    def handle_tag_86(self, data):
+        self.current_transaction['name'] = data
+
+
+class MT940RaboSeparated(MT940Rabo):
+    """Parser inserting a separator between the lines of a record."""
+
+    def add_record_line(self, line, record_line):
+        return record_line + ' ' + line
+
+
 class TestImport(TransactionCase):
     """Run test to import mt940 import."""
     transactions = [
@@ -123,6 +143,71 @@ class TestImport(TransactionCase):
                     self.assertTrue(line.name == transact['name'])
                     self.assertTrue(line.ref == transact['ref'])
 
+    def test_iter_statements(self):
+        """Test streaming statements gives the same result as parse."""
+        testfile = get_module_resource(
+            'account_bank_statement_import_mt940_base',
+            'test_files',
+            'test-sns.940',
+        )
+        datafile = open(testfile, 'rb').read()
+        statements = MT940().parse(datafile, header_lines=1)[2]
+        parser = MT940()
+        parser.read_size = 7  # Force chunk boundaries inside tags
+        streamed = list(
+            parser.iter_statements(BytesIO(datafile), header_lines=1))
+        self.assertEqual(streamed, statements)
+        self.assertFalse(parser.statements)
+        self.assertEqual(parser.account_number, 'NL05SNSB0908244436')
+
+    def test_parse_parallel(self):
+        """Test parsing statements in worker processes."""
+        testfile = get_module_resource(
+            'account_bank_statement_import_mt940_base',
+            'test_files',
+            'test-sns.940',
+        )
+        datafile = open(testfile, 'rb').read()
+        serial = MT940().parse(datafile, header_lines=1)
+        parser = MT940()
+        parser.max_workers = 2
+        parser.parallel_threshold = 0
+        self.assertEqual(parser.parse(datafile, header_lines=1), serial)
+
+    def test_subclass_dispatch(self):
+        """Test regexes and tag handlers set up by a subclass."""
+        parser = MT940Rabo()
+        self.assertTrue(parser.header_regex_compiled.match(':940:'))
+        self.assertIs(
+            parser.get_tag_handlers()['86'], MT940Rabo.handle_tag_86)
+        self.assertIs(parser.get_tag_handlers()['61'], MT940.handle_tag_61)
+        testfile = get_module_resource(
+            'account_bank_statement_import_mt940_base',
+            'test_files',
+            'test-rabo.swi',
+        )
+        datafile = open(testfile, 'rb').read()
+        statements = parser.parse(datafile)[2]
+        self.assertEqual(
+            statements[-2]['transactions'][0]['name'],
+            '/BENM//NAME/Kosten/REMI/Periode 01-10-2013 t/m 31-12-2013'
+            '/ISDT/2014-01-01')
+
+    def test_add_record_line(self):
+        """Test overriding how the lines of a record are joined."""
+        testfile = get_module_resource(
+            'account_bank_statement_import_mt940_base',
+            'test_files',
+            'test-rabo.swi',
+        )
+        datafile = open(testfile, 'rb').read()
+        statements = MT940RaboSeparated().parse(datafile)[2]
+        self.assertEqual(
+            statements[1]['transactions'][0]['name'],
+            '/ORDP//NAME/R. SMITH/ADDR/Green market 74 3311BE Sheepcity '
+            'Nederl and NL/REMI/Test money paid by other partner: '
+            '/ISDT/2014-01-02')
+
     def test_get_subfields(self):
         """Unit Test function get_subfields()."""
 
@@ -0,0 +1,69 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Normalise bank account numbers, to match them with journals.
+
+Banks report either the IBAN or the domestic account number of an account.
+The domestic account number is read from the IBAN with the template of its
+country. Results are cached, as the same journal accounts are normalised on
+each import.
+
+Only the OFX import uses this module. The other formats of this repository
+do not depend on this addon: they keep the matching of account_number by
+account_bank_statement_import, on the sanitized number of the journal. To
+share it, it would have to move to an addon that all of them depend on.
+"""
+import functools
+
+from odoo.addons.base.res.res_partner_bank import sanitize_account_number
+from odoo.addons.base_iban.models.res_partner_bank import _map_iban_template
+from odoo.addons.base_iban.models.res_partner_bank import validate_iban
+from odoo.exceptions import ValidationError
+
+# Positions of the domestic account number in the IBAN of each country,
+# after the country code and the check digits
+IBAN_ACCOUNT_MASKS = dict(
+    (country_code, tuple(
+        index for index, char in enumerate(template.replace(' ', ''))
+        if index >= 4 and char == 'C'))
+    for country_code, template in _map_iban_template.items()
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_domestic_account_number(iban):
+    """Return the domestic account number of an IBAN.
+
+    Return None if iban is not a valid IBAN, or if its template has no
+    account number."""
+    iban = sanitize_account_number(iban)
+    if not iban:
+        return None
+    try:
+        validate_iban(iban)
+    except ValidationError:
+        return None
+    mask = IBAN_ACCOUNT_MASKS.get(iban[:2].lower())
+    if not mask:
+        return None
+    return ''.join(iban[index] for index in mask)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_account_number_keys(account_number):
+    """Return the numbers a bank may report for an account, sanitized.
+
+    These are the account number itself and, for an IBAN, its domestic
+    account number."""
+    account_number = sanitize_account_number(account_number)
+    if not account_number:
+        return frozenset()
+    domestic_account_number = get_domestic_account_number(account_number)
+    if domestic_account_number:
+        return frozenset([account_number, domestic_account_number])
+    return frozenset([account_number])
+
+
+def match_account_number(account_number, reported_account_number):
+    """Return whether a bank reports an account as reported_account_number.
+    """
+    return sanitize_account_number(reported_account_number) in (
+        get_account_number_keys(account_number))
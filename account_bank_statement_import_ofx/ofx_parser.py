@@ -0,0 +1,357 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Parse OFX files without building a tree of the whole file.
+
+Both OFX 1.x (SGML, with unclosed elements) and OFX 2.x (XML) files are
+read as a stream of tags. The result has the attributes of the result of
+ofxparse that are used to import statements. Files that use parts of OFX
+this parser does not handle raise OfxUnsupportedError, so that they can
+be parsed by ofxparse instead.
+"""
+import codecs
+import datetime
+import html
+import re
+
+# Tags, comments and processing instructions. Any other '<' is unsupported.
+RE_OFX = re.compile(br'<ofx[\s>]', re.IGNORECASE)
+# XML declaration of OFX 2.x files, after an optional BOM
+RE_XML_DECLARATION = re.compile(br'^(?:\xef\xbb\xbf)?\s*<\?xml\s([^>]*)>')
+RE_XML_ENCODING = re.compile(br'encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+RE_TOKEN = re.compile(
+    r'<(/?)([A-Za-z0-9_.]+)>|<!--.*?-->|<\?[^>]*>|<', re.DOTALL)
+RE_TIMEZONE = re.compile(r'\[(?P<tz>[-+]?\d+\.?\d*)\:\w*\]$')
+RE_FRACTION = re.compile(r'^[0-9]*\.([0-9]{0,5})')
+RE_THOUSANDS_DOT = re.compile(r'.*\..*,')
+RE_THOUSANDS_COMMA = re.compile(r'.*,.*\.')
+
+# Elements of statements, for bank accounts and credit cards
+STATEMENT_TAGS = ('STMTRS', 'CCSTMTRS')
+# Elements for investments and account information are left to ofxparse
+UNSUPPORTED_TAGS = ('INVSTMTRS', 'ACCTINFORS')
+BALANCE_TAGS = ('LEDGERBAL', 'AVAILBAL')
+
+
+class OfxUnsupportedError(ValueError):
+    """The file cannot be parsed by this parser."""
+
+
+class OfxTransaction(object):
+    __slots__ = (
+        'type', 'payee', 'memo', 'amount', 'date', 'user_date', 'id', 'sic',
+        'checknum')
+
+    def __init__(self):
+        self.type = ''
+        self.payee = ''
+        self.memo = ''
+        self.amount = None
+        self.date = None
+        self.user_date = None
+        self.id = ''
+        self.sic = None
+        self.checknum = ''
+
+
+class OfxStatement(object):
+
+    def __init__(self):
+        self.start_date = ''
+        self.end_date = ''
+        self.currency = ''
+        self.balance = None
+        self.balance_date = None
+        self.available_balance = None
+        self.available_balance_date = None
+        self.transactions = []
+
+
+class OfxAccount(object):
+
+    def __init__(self, statement_tag):
+        self.statement_tag = statement_tag
+        self.curdef = None
+        self.account_id = ''
+        self.routing_number = ''
+        self.branch_id = ''
+        self.account_type = ''
+        self.statement = OfxStatement()
+
+    @property
+    def number(self):
+        return self.account_id
+
+
+class Ofx(object):
+
+    def __init__(self, headers, accounts):
+        self.headers = headers
+        self.accounts = accounts
+        self.account = accounts[0] if accounts else None
+
+
+def is_ofx(data):
+    """Return whether data (bytes) has an OFX element, which any parser of
+    OFX files needs."""
+    return bool(RE_OFX.search(data))
+
+
+def parse_datetime(value):
+    """Return the datetime in UTC of an OFX date, as ofxparse does.
+
+    For instance 20101106160000.00[-5:EST] is 6 Nov 2010 4pm UTC-5."""
+    match = RE_TIMEZONE.search(value)
+    offset = datetime.timedelta(hours=float(match.group('tz')) if match else 0)
+    match = RE_FRACTION.search(value)
+    fraction = datetime.timedelta(
+        seconds=float('0.' + match.group(1)) if match else 0)
+    try:
+        local = datetime.datetime.strptime(value[:14], '%Y%m%d%H%M%S')
+    except ValueError:
+        if value[:8] == '00000000':
+            return None
+        local = datetime.datetime.strptime(value[:8], '%Y%m%d')
+    return local - offset + fraction
+
+
+def parse_amount(value):
+    """Return the float of an OFX amount, in any of the formats banks use.
+
+    For instance 10,000.50, 10.000,50, 10000,50, 1 025,53 or +1058,53."""
+    if RE_THOUSANDS_DOT.search(value):
+        value = value.replace('.', '')
+    if RE_THOUSANDS_COMMA.search(value):
+        value = value.replace(',', '')
+    if '.' not in value and ',' in value:
+        value = value.replace(',', '.')
+    return float(value.replace(' ', '').replace('+', ''))
+
+
+class OfxParser(object):
+    """Parse an OFX file into accounts with their statement."""
+
+    def read_headers(self, data):
+        """Return the OFX 1.x headers at the start of data."""
+        head = data[:10240]
+        head = head[:head.find(b'<')]
+        headers = {}
+        for line in head.splitlines():
+            if not line.strip():
+                break
+            try:
+                name, value = line.split(b':')
+            except ValueError:
+                raise OfxUnsupportedError("Invalid OFX header %r" % line)
+            headers[name.strip().upper().decode('ascii', 'replace')] = (
+                value.strip().decode('ascii', 'replace'))
+        return headers
+
+    def get_encoding(self, headers):
+        """Return the encoding of the file, from its headers."""
+        encoding = headers.get('ENCODING')
+        if not encoding:
+            return 'ascii'
+        if encoding == 'USASCII':
+            charset = headers.get('CHARSET', '1252')
+            encoding = (
+                'iso-8859-1' if charset == '8859-1' else 'cp%s' % charset)
+        elif encoding in ('UNICODE', 'UTF-8'):
+            encoding = 'utf-8'
+        else:
+            raise OfxUnsupportedError("Unknown OFX encoding %s" % encoding)
+        try:
+            return codecs.lookup(encoding).name
+        except LookupError:
+            raise OfxUnsupportedError("Unknown OFX encoding %s" % encoding)
+
+    def get_xml_encoding(self, data):
+        """Return the encoding of an OFX 2.x file, from its XML declaration,
+        or None for an OFX 1.x file.
+
+        As for any XML file, the encoding is UTF-8 unless declared."""
+        match = RE_XML_DECLARATION.match(data)
+        if match is None:
+            return None
+        match = RE_XML_ENCODING.search(match.group(1))
+        if match is None:
+            return 'utf-8'
+        encoding = match.group(1).decode('ascii')
+        try:
+            return codecs.lookup(encoding).name
+        except LookupError:
+            raise OfxUnsupportedError("Unknown XML encoding %s" % encoding)
+
+    def iter_tokens(self, text):
+        """Yield (tag, value) for start tags and (tag, None) for end tags.
+
+        End tags are prefixed by '/'. The value of a start tag is the text up
+        to the next tag, unescaped."""
+        tag = None
+        start = 0
+        for match in RE_TOKEN.finditer(text):
+            if tag is not None:
+                value = text[start:match.start()]
+                if '&' in value:
+                    value = html.unescape(value)
+                yield tag, value
+                tag = None
+            if match.group(2):
+                if match.group(1):
+                    yield '/' + match.group(2).upper(), None
+                else:
+                    tag = match.group(2).upper()
+                    start = match.end()
+            elif match.group(0) == '<':
+                raise OfxUnsupportedError(
+                    "Unsupported markup at position %d" % match.start())
+        if tag is not None:
+            yield tag, html.unescape(text[start:])
+
+    def parse(self, data):
+        """Return an Ofx object with the statements of data (bytes)."""
+        encoding = self.get_xml_encoding(data)
+        if encoding is None:
+            headers = self.read_headers(data)
+            encoding = self.get_encoding(headers)
+        else:
+            # OFX 2.x headers are attributes of a processing instruction
+            headers = {}
+        try:
+            text = data.decode(encoding)
+        except UnicodeDecodeError as e:
+            raise OfxUnsupportedError(str(e))
+        has_ofx = False
+        accounts = dict((tag, []) for tag in STATEMENT_TAGS)
+        account = None
+        # First value of each tag in the statement, its balances and the
+        # current transaction
+        values = balance_values = transaction_values = None
+        balances = {}
+        for tag, value in self.iter_tokens(text):
+            if tag == 'OFX':
+                has_ofx = True
+            elif tag in UNSUPPORTED_TAGS:
+                raise OfxUnsupportedError("Unsupported element %s" % tag)
+            elif tag in STATEMENT_TAGS:
+                if account is not None:
+                    raise OfxUnsupportedError("Nested element %s" % tag)
+                account = OfxAccount(tag)
+                values = {}
+                balances = {}
+            elif account is None:
+                continue
+            elif tag == '/' + account.statement_tag:
+                if transaction_values is not None or (
+                        balance_values is not None):
+                    raise OfxUnsupportedError("Unclosed element in %s" % tag)
+                self.set_statement_values(account, values, balances)
+                accounts[account.statement_tag].append(account)
+                account = None
+            elif tag == 'STMTTRN':
+                if transaction_values is not None:
+                    raise OfxUnsupportedError("Nested element %s" % tag)
+                transaction_values = {}
+            elif tag == '/STMTTRN':
+                if transaction_values is None:
+                    raise OfxUnsupportedError("Unopened element %s" % tag)
+                account.statement.transactions.append(
+                    self.get_transaction(transaction_values))
+                transaction_values = None
+            elif tag in BALANCE_TAGS:
+                if balance_values is not None:
+                    raise OfxUnsupportedError("Nested element %s" % tag)
+                balance_values = {}
+                # Only the first balance of each type is read
+                if tag not in balances:
+                    balances[tag] = balance_values
+            elif tag.startswith('/') and tag[1:] in BALANCE_TAGS:
+                balance_values = None
+            elif value is not None:
+                values.setdefault(tag, value)
+                if transaction_values is not None:
+                    transaction_values.setdefault(tag, value)
+                if balance_values is not None:
+                    balance_values.setdefault(tag, value)
+        if account is not None:
+            raise OfxUnsupportedError(
+                "Unclosed element %s" % account.statement_tag)
+        if not has_ofx:
+            raise OfxUnsupportedError("The file is not an OFX file")
+        return Ofx(headers, [
+            account for tag in STATEMENT_TAGS for account in accounts[tag]
+        ])
+
+    def get_value(self, values, tag, required=False):
+        """Return the stripped value of tag, or None if it is not found.
+
+        Raise an error for an empty element, or if a required element is not
+        found."""
+        value = values.get(tag)
+        if value is None:
+            if required:
+                raise OfxUnsupportedError("Missing element %s" % tag)
+            return None
+        if not value:
+            raise OfxUnsupportedError("Empty element %s" % tag)
+        return value.strip()
+
+    def get_datetime(self, values, tag, required=False):
+        """Return the datetime of tag, or None if it is not found."""
+        value = self.get_value(values, tag, required)
+        if value is None:
+            return None
+        try:
+            return parse_datetime(value)
+        except ValueError as e:
+            raise OfxUnsupportedError(str(e))
+
+    def set_statement_values(self, account, values, balances):
+        """Set the values of an account and of its statement."""
+        for attr, tag in (('curdef', 'CURDEF'), ('account_id', 'ACCTID'),
+                          ('routing_number', 'BANKID'),
+                          ('branch_id', 'BRANCHID'),
+                          ('account_type', 'ACCTTYPE')):
+            if values.get(tag):
+                setattr(account, attr, values[tag].strip())
+        statement = account.statement
+        statement.start_date = self.get_datetime(values, 'DTSTART') or ''
+        statement.end_date = self.get_datetime(values, 'DTEND') or ''
+        currency = self.get_value(values, 'CURDEF')
+        if currency is not None:
+            statement.currency = currency.lower()
+        for tag, attr in (('LEDGERBAL', 'balance'),
+                          ('AVAILBAL', 'available_balance')):
+            balance_values = balances.get(tag, {})
+            amount = self.get_value(balance_values, 'BALAMT')
+            if amount is not None:
+                try:
+                    setattr(statement, attr, parse_amount(amount))
+                except ValueError:
+                    raise OfxUnsupportedError("Invalid %s amount" % tag)
+            setattr(statement, attr + '_date',
+                    self.get_datetime(balance_values, 'DTASOF'))
+
+    def get_transaction(self, values):
+        """Return the transaction of the values of a STMTTRN element."""
+        transaction = OfxTransaction()
+        transaction_type = self.get_value(values, 'TRNTYPE')
+        if transaction_type is not None:
+            transaction.type = transaction_type.lower()
+        transaction.payee = self.get_value(values, 'NAME') or ''
+        # The memo may be empty
+        transaction.memo = values.get('MEMO', '').strip()
+        amount = self.get_value(values, 'TRNAMT', required=True)
+        try:
+            transaction.amount = parse_amount(amount)
+        except ValueError:
+            # Some banks use a null transaction for interest rate changes
+            if amount not in ('null', '-null'):
+                raise OfxUnsupportedError(
+                    "Invalid transaction amount %s" % amount)
+            transaction.amount = 0.0
+        transaction.date = self.get_datetime(
+            values, 'DTPOSTED', required=True)
+        transaction.user_date = self.get_datetime(values, 'DTUSER')
+        transaction.id = self.get_value(values, 'FITID', required=True)
+        transaction.sic = self.get_value(values, 'SIC')
+        transaction.checknum = self.get_value(values, 'CHECKNUM') or ''
+        return transaction
@@ -1,6 +1,12 @@
+from odoo.exceptions import UserError
 from odoo.tests.common import TransactionCase
 from odoo.modules.module import get_module_resource
 import base64
+import datetime
+import io
+from ofxparse import OfxParser
+from .. import account_number
+from .. import ofx_parser
 
 
 class TestOfxFile(TransactionCase):
@@ -84,3 +90,149 @@ class TestOfxFile(TransactionCase):
                                                   '12345678901')
         self.assertTrue(res)
         bank_st.with_context(journal_id=journal_iban_ofx.id).import_file()
+
+    def test_account_number(self):
+        self.assertEqual(
+            account_number.get_domestic_account_number(
+                'fr76 3000 1007 9412 3456 7890 185'),
+            '12345678901')
+        # The country code is not part of the account number
+        self.assertEqual(
+            account_number.get_domestic_account_number(
+                'CH9300762011623852957'),
+            '011623852957')
+        self.assertIsNone(
+            account_number.get_domestic_account_number('123412341234'))
+        self.assertTrue(account_number.match_account_number(
+            'FR7630001007941234567890185', '12345678901'))
+        self.assertTrue(account_number.match_account_number(
+            'FR7630001007941234567890185',
+            'FR76 3000 1007 9412 3456 7890 185'))
+        self.assertFalse(account_number.match_account_number(
+            '123412341234', '123456'))
+        self.assertFalse(account_number.match_account_number(False, '123456'))
+
+    def test_ofx_file_import_accounts(self):
+        """The statements of each account of the file are imported."""
+        ofx_file_path = get_module_resource(
+            'account_bank_statement_import_ofx',
+            'tests/test_ofx_file/', 'test_ofx.ofx')
+        data = open(ofx_file_path, 'rb').read()
+        # Only the account with transactions is imported
+        self.assertEqual(
+            [statements[1] for statements in
+             self.absi_model._get_ofx_statements(
+                 ofx_parser.OfxParser().parse(data))],
+            ['123456'])
+        data = data.replace(
+            b'<BANKTRANLIST>\n        </BANKTRANLIST>',
+            b'<BANKTRANLIST><STMTTRN><TRNTYPE>DEBIT</TRNTYPE>'
+            b'<DTPOSTED>20130825</DTPOSTED><TRNAMT>-12.50</TRNAMT>'
+            b'<FITID>CC1</FITID><NAME>Card</NAME></STMTTRN></BANKTRANLIST>')
+        bank = self.env['res.partner.bank'].create({
+            'acc_number': '123412341234',
+            'partner_id': self.env.ref('base.main_partner').id,
+            'company_id': self.env.ref('base.main_company').id,
+            'bank_id': self.env.ref('base.res_bank_1').id,
+        })
+        journal = self.j_model.create({
+            'name': 'Credit Card Journal TEST OFX',
+            'code': 'CC12',
+            'type': 'bank',
+            'bank_account_id': bank.id,
+        })
+        # From a journal, only the account of the journal is imported
+        action = self.absi_model.with_context(
+            journal_id=journal.id,
+        ).create(dict(data_file=base64.b64encode(data))).import_file()
+        statements = self.abs_model.browse(
+            action['context']['statement_ids'])
+        self.assertEqual(statements.mapped('name'), ['123412341234'])
+        self.assertEqual(statements.balance_start, -549.5)
+        # The other accounts are reported
+        self.assertIn('123456', action['context']['notifications'][0][
+            'message'])
+        statements.unlink()
+        action = self.absi_model.create(
+            dict(data_file=base64.b64encode(data))).import_file()
+        statements = self.abs_model.browse(
+            action['context']['statement_ids'])
+        self.assertEqual(
+            sorted(statements.mapped('name')), ['123412341234', '123456'])
+        self.assertEqual(
+            statements.filtered(lambda s: s.name == '123456').journal_id.code,
+            'BNK12')
+        # After the journal creation wizard, all accounts are imported, and
+        # the accounts already imported are reported
+        statements.filtered(lambda s: s.name == '123456').unlink()
+        action = self.absi_model.with_context(
+            journal_id=journal.id, ofx_all_accounts=True,
+        ).create(dict(data_file=base64.b64encode(data))).import_file()
+        statements = self.abs_model.browse(
+            action['context']['statement_ids'])
+        self.assertEqual(statements.mapped('name'), ['123456'])
+        self.assertIn('123412341234', action['context']['notifications'][-1][
+            'message'])
+        with self.assertRaises(UserError):
+            self.absi_model.create(
+                dict(data_file=base64.b64encode(data))).import_file()
+
+    def test_ofx_parser(self):
+        for file_name in ['test_ofx.ofx', 'test_ofx_iban.ofx']:
+            ofx_file_path = get_module_resource(
+                'account_bank_statement_import_ofx',
+                'tests/test_ofx_file/', file_name)
+            data = open(ofx_file_path, 'rb').read()
+            ofx = ofx_parser.OfxParser().parse(data)
+            expected = OfxParser.parse(io.BytesIO(data))
+            self.assertEqual(len(ofx.accounts), len(expected.accounts))
+            for account, expected_account in zip(
+                    ofx.accounts, expected.accounts):
+                self.assertEqual(account.number, expected_account.number)
+                statement = account.statement
+                expected_statement = expected_account.statement
+                self.assertEqual(
+                    statement.currency, expected_statement.currency)
+                self.assertEqual(
+                    statement.balance, float(expected_statement.balance))
+                self.assertEqual(
+                    [(t.id, t.payee, t.memo, t.amount, t.date)
+                     for t in statement.transactions],
+                    [(t.id, t.payee, t.memo, float(t.amount), t.date)
+                     for t in expected_statement.transactions])
+        # OFX 2.x files are read in the encoding of their XML declaration,
+        # or else in UTF-8
+        for declaration, payee in [
+                (b'encoding="UTF-8"', 'Agrolait Caf\xe9'.encode('utf-8')),
+                (b'', 'Agrolait Caf\xe9'.encode('utf-8')),
+                (b'encoding="ISO-8859-1"', b'Agrolait Caf\xe9')]:
+            ofx = ofx_parser.OfxParser().parse(data.replace(
+                b'encoding="ASCII"', declaration).replace(
+                b'<NAME>Agrolait<', b'<NAME>' + payee + b'<'))
+            self.assertEqual(
+                ofx.account.statement.transactions[0].payee,
+                'Agrolait Caf\xe9')
+
+    def test_ofx_parser_sgml(self):
+        data = (
+            b'OFXHEADER:100\nDATA:OFXSGML\nVERSION:102\n'
+            b'ENCODING:USASCII\nCHARSET:1252\n\n'
+            b'<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><CURDEF>EUR'
+            b'<BANKACCTFROM><ACCTID>123456</BANKACCTFROM><BANKTRANLIST>'
+            b'<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20130824120000[-5:EST]'
+            b'<TRNAMT>-1.000,50<FITID>1<NAME>Caf\xe9 &amp; Co<MEMO>\n'
+            b'</STMTTRN></BANKTRANLIST>'
+            b'<LEDGERBAL><BALAMT>1 234,56<DTASOF>20130831</LEDGERBAL>'
+            b'</STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>')
+        ofx = ofx_parser.OfxParser().parse(data)
+        self.assertEqual(ofx.account.number, '123456')
+        self.assertEqual(ofx.account.statement.currency, 'eur')
+        self.assertEqual(ofx.account.statement.balance, 1234.56)
+        transaction = ofx.account.statement.transactions[0]
+        self.assertEqual(transaction.payee, 'Caf\xe9 & Co')
+        self.assertEqual(transaction.memo, '')
+        self.assertEqual(transaction.amount, -1000.5)
+        self.assertEqual(
+            transaction.date, datetime.datetime(2013, 8, 24, 17, 0))
+        with self.assertRaises(ofx_parser.OfxUnsupportedError):
+            ofx_parser.OfxParser().parse(data.replace(b'</STMTTRN>', b''))
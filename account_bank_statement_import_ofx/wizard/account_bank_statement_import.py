@@ -1,10 +1,12 @@
+import base64
+import collections
 import logging
 import io
 
 from odoo import api, models, _
 from odoo.exceptions import UserError
-from odoo.addons.base_iban.models.res_partner_bank import _map_iban_template
-from odoo.addons.base_iban.models.res_partner_bank import validate_iban
+from ..account_number import match_account_number
+from .. import ofx_parser
 
 _logger = logging.getLogger(__name__)
 
@@ -23,19 +25,24 @@ class AccountBankStatementImport(models.TransientModel):
             AccountBankStatementImport, self
         )._check_journal_bank_account(journal, account_number)
         if not res:
-            e_acc_num = journal.bank_account_id.sanitized_acc_number
-            e_acc_num = e_acc_num.replace(" ", "")
-            validate_iban(e_acc_num)
-            country_code = e_acc_num[:2].lower()
-            iban_template = _map_iban_template[country_code].replace(
-                " ", "")
-            e_acc_num = "".join(
-                [c for c, t in zip(e_acc_num, iban_template) if t == "C"])
-            res = (e_acc_num == account_number)
+            # The bank may report the domestic account number of the IBAN
+            res = match_account_number(
+                journal.bank_account_id.sanitized_acc_number,
+                account_number)
         return res
 
     @api.model
     def _check_ofx(self, data_file):
+        """Return the parsed file, or False if it is not an OFX file.
+
+        Files are parsed by ofx_parser, or by ofxparse if they use parts of
+        OFX that ofx_parser does not handle."""
+        if not ofx_parser.is_ofx(data_file):
+            return False
+        try:
+            return ofx_parser.OfxParser().parse(data_file)
+        except ofx_parser.OfxUnsupportedError as e:
+            _logger.debug("Parsing with ofxparse: %s", e)
         if not OfxParser:
             return False
         try:
@@ -63,16 +70,13 @@ class AccountBankStatementImport(models.TransientModel):
         }
         return vals
 
-    def _parse_file(self, data_file):
-        ofx = self._check_ofx(data_file)
-        if not ofx:
-            return super(AccountBankStatementImport, self)._parse_file(
-                data_file)
-
+    @api.model
+    def _prepare_ofx_statement(self, account):
+        """Return the values of the statement of an account of the file."""
         transactions = []
         total_amt = 0.00
         try:
-            for transaction in ofx.account.statement.transactions:
+            for transaction in account.statement.transactions:
                 vals = self._prepare_ofx_transaction_line(transaction)
                 if vals:
                     transactions.append(vals)
@@ -80,14 +84,140 @@ class AccountBankStatementImport(models.TransientModel):
         except Exception as e:
             raise UserError(_(
                 "The following problem occurred during import. "
-                "The file might not be valid.\n\n %s") % e.message)
+                "The file might not be valid.\n\n %s") % e)
 
-        balance = float(ofx.account.statement.balance)
-        vals_bank_statement = {
-            'name': ofx.account.number,
+        balance = float(account.statement.balance)
+        return {
+            'name': account.number,
             'transactions': transactions,
             'balance_start': balance - total_amt,
             'balance_end_real': balance,
         }
-        return ofx.account.statement.currency, ofx.account.number, [
-            vals_bank_statement]
+
+    @api.model
+    def _get_ofx_statements(self, ofx):
+        """Return currency, account number and statements of each account.
+
+        Accounts without transactions are left out, unless no account has
+        any. The statements of an account that appears several times in the
+        file are returned together."""
+        accounts = [
+            account for account in ofx.accounts
+            if account.statement.transactions
+        ] or ofx.accounts[:1]
+        statements = collections.OrderedDict()
+        for account in accounts:
+            statements.setdefault(
+                (account.statement.currency, account.number), []
+            ).append(self._prepare_ofx_statement(account))
+        return [
+            (currency, account_number, account_statements)
+            for (currency, account_number), account_statements
+            in statements.items()
+        ]
+
+    @api.multi
+    def import_file(self):
+        """Import the statements of each account of an OFX file.
+
+        The file is parsed once. The statements of each account are then
+        imported in the journal of the account, one account after the other.
+        When imported from a journal, only the accounts of the journal are
+        imported, and the other accounts are reported. Once a journal is
+        created for an account of the file, all its accounts are imported.
+        The accounts that cannot be imported, e.g. because they were already
+        imported, are reported instead of aborting the other accounts."""
+        self.ensure_one()
+        ofx = self._check_ofx(base64.b64decode(self.data_file))
+        if not ofx:
+            return super(AccountBankStatementImport, self).import_file()
+        ofx_statements = self._get_ofx_statements(ofx)
+        wizard = self
+        notifications = []
+        journal_id = self.env.context.get('journal_id')
+        if self.env.context.get('ofx_all_accounts'):
+            # The journal creation wizard passes the created journal, which
+            # is found from its account like the journals of other accounts
+            wizard = self.with_context(journal_id=False)
+        elif journal_id and len(ofx_statements) > 1:
+            journal = self.env['account.journal'].browse(journal_id)
+            if journal.bank_account_id:
+                journal_statements = [
+                    statements for statements in ofx_statements
+                    if self._check_journal_bank_account(
+                        journal, statements[1])
+                ] or ofx_statements[:1]
+            else:
+                journal_statements = ofx_statements[:1]
+            for statements in ofx_statements:
+                if statements not in journal_statements:
+                    notifications.append({
+                        'type': 'warning',
+                        'message': _(
+                            "The statements of the account %s were not "
+                            "imported, as it is not the account of the "
+                            "journal %s.") % (statements[1], journal.name),
+                    })
+            ofx_statements = journal_statements
+        if not ofx_statements:
+            # Let the import report that there is no statement
+            return super(AccountBankStatementImport, wizard.with_context(
+                ofx_statements=[])).import_file()
+        # Accounts without journal are imported first, so that the journal
+        # creation wizard is shown before any statement is created
+        for statements in ofx_statements:
+            currency_code, account_number = statements[:2]
+            if not wizard._find_additional_data(
+                    currency_code, account_number)[1]:
+                action = super(AccountBankStatementImport, wizard.with_context(
+                    ofx_statements=[statements])).import_file()
+                if len(ofx_statements) > 1:
+                    action['context'] = dict(
+                        action.get('context') or {}, ofx_all_accounts=True)
+                return action
+        statement_ids = []
+        result = None
+        error = None
+        for index, statements in enumerate(ofx_statements):
+            try:
+                with self.env.cr.savepoint():
+                    action = super(
+                        AccountBankStatementImport, wizard.with_context(
+                            ofx_statements=ofx_statements,
+                            ofx_statement_index=index,
+                        )).import_file()
+            except UserError as e:
+                error = error or e
+                notifications.append({
+                    'type': 'warning',
+                    'message': _(
+                        "The statements of the account %s were not "
+                        "imported: %s") % (statements[1], e.name),
+                })
+                continue
+            result = action
+            statement_ids += action['context']['statement_ids']
+            notifications += action['context']['notifications']
+        if result is None:
+            raise error
+        result['context'] = dict(
+            result['context'], statement_ids=statement_ids,
+            notifications=notifications)
+        return result
+
+    def _parse_file(self, data_file):
+        """Return the statements of an account of the file.
+
+        import_file passes the statements of all accounts in the context,
+        so that the file is not parsed again for each account. Otherwise,
+        the statements of the first account are returned."""
+        ofx_statements = self.env.context.get('ofx_statements')
+        if ofx_statements is None:
+            ofx = self._check_ofx(data_file)
+            if not ofx:
+                return super(AccountBankStatementImport, self)._parse_file(
+                    data_file)
+            ofx_statements = self._get_ofx_statements(ofx)
+        if not ofx_statements:
+            return None, None, []
+        return ofx_statements[self.env.context.get('ofx_statement_index', 0)]
@@ -3,12 +3,15 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+import codecs
+import io
+import itertools
 import logging
 from datetime import datetime
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
+from odoo.osv import expression
 import re
-from io import StringIO
 _logger = logging.getLogger(__name__)
 
 try:
@@ -33,6 +36,48 @@ HEADERS = [
     '"Reference Txn ID"',
     ]
 
+# Statement line values read from a Paypal file, in the order of the
+# columns of the HEADERS. Columns that are not used are None.
+COLUMNS = [
+    'date', 'time', None, 'description', 'currency', 'amount', 'commission',
+    None, 'balance', 'transaction_id', 'email', 'partner_name',
+    # This two field are useful for bank transfer
+    'bank_name', 'bank_account',
+    None, None, 'invoice_number', 'origin_transaction_id',
+    ]
+
+# Number of bytes at the start of a file in which the header is looked for
+PAYPAL_SNIFF_SIZE = 4096
+
+# Number of characters of the date that identify a period to split by
+SPLIT_DATE_SIZES = {
+    'day': len('2017-01-31'),
+    'month': len('2017-01'),
+    }
+
+# Number of partner names searched together
+PAYPAL_SEARCH_CHUNK_SIZE = 500
+
+# Characters of partner names that =ilike does not match literally
+RE_LIKE_WILDCARD = re.compile(r'[%_\\]')
+
+
+def get_column_titles():
+    """Return the value of each column title of the HEADERS."""
+    titles = {}
+    for header in HEADERS:
+        for title, column in zip(next(csv.reader([header])), COLUMNS):
+            if column:
+                titles[title.strip()] = column
+    return titles
+
+
+COLUMN_TITLES = get_column_titles()
+
+# Columns of the HEADERS, for files read without their header line
+DEFAULT_COLUMNS = dict(
+    (column, index) for index, column in enumerate(COLUMNS) if column)
+
 
 class AccountBankStatementImport(models.TransientModel):
     _inherit = 'account.bank.statement.import'
@@ -43,9 +88,30 @@ class AccountBankStatementImport(models.TransientModel):
 
     @api.model
     def _get_paypal_str_data(self, data_file):
+        """Return the whole file decoded.
+
+        The file is only decoded this way when another module overrides
+        this method: otherwise it is decoded as it is read."""
         if not isinstance(data_file, str):
             data_file = data_file.decode(self._get_paypal_encoding())
-        return data_file.strip()
+        return data_file.lstrip('\ufeff').strip()
+
+    def _is_paypal_hook_overridden(self, method_name):
+        """Return whether another module overrides a method of this one."""
+        return getattr(type(self), method_name) is not getattr(
+            AccountBankStatementImport, method_name)
+
+    @api.model
+    def _open_paypal_file(self, data_file):
+        """Return the file as a text stream, decoded as it is read."""
+        if self._is_paypal_hook_overridden('_get_paypal_str_data'):
+            return io.StringIO(
+                self._get_paypal_str_data(data_file), newline='')
+        if isinstance(data_file, str):
+            return io.StringIO(data_file.lstrip('\ufeff'), newline='')
+        return io.TextIOWrapper(
+            io.BytesIO(data_file), encoding=self._get_paypal_encoding(),
+            newline='')
 
     @api.model
     def _get_paypal_date_format(self):
@@ -60,67 +126,166 @@ class AccountBankStatementImport(models.TransientModel):
         valstrdot = valstrdot.replace(',', '.')
         return float(valstrdot)
 
+    @api.model
+    def _get_paypal_prefix(self, data_file):
+        """Return the decoded start of the file, without BOM and leading
+        whitespace, or None if it cannot be decoded."""
+        if self._is_paypal_hook_overridden('_get_paypal_str_data'):
+            try:
+                return self._get_paypal_str_data(
+                    data_file)[:PAYPAL_SNIFF_SIZE].lstrip()
+            except UnicodeDecodeError:
+                return None
+        prefix = data_file[:PAYPAL_SNIFF_SIZE]
+        if not isinstance(prefix, str):
+            # A multi-byte character may be cut at the end of the prefix
+            decoder = codecs.getincrementaldecoder(
+                self._get_paypal_encoding())()
+            try:
+                prefix = decoder.decode(prefix, final=False)
+            except UnicodeDecodeError:
+                return None
+        return prefix.lstrip('\ufeff').lstrip()
+
     @api.model
     def _check_paypal(self, data_file):
-        data_file = self._get_paypal_str_data(data_file)
-        for header in HEADERS:
-            if data_file.strip().startswith(header):
-                return True
-        return False
-
-    def _convert_paypal_line_to_dict(self, idx, line):
-        date_dt = datetime.strptime(line[0], self._get_paypal_date_format())
-        rline = {
-            'date': fields.Date.to_string(date_dt),
-            'time': line[1],
-            'description': line[3],
-            'currency': line[4],
-            'amount': line[5],
-            'commission': line[6],
-            'balance': line[8],
-            'transaction_id': line[9],
-            'email': line[10],
-            'partner_name': line[11],
-            # This two field are useful for bank transfer
-            'bank_name': line[12],
-            'bank_account': line[13],
-            'invoice_number': line[16],
-            'origin_transaction_id': line[17],
-            'idx': idx,
-        }
+        """Return whether the header line of the file has the titles of all
+        the used columns, in any order."""
+        prefix = self._get_paypal_prefix(data_file)
+        if not prefix:
+            return False
+        header = next(csv.reader(prefix.splitlines()[:1]), [])
+        titles = set(COLUMN_TITLES.get(title.strip()) for title in header)
+        return all(column in titles for column in COLUMNS if column)
+
+    @api.model
+    def _get_paypal_columns(self, header):
+        """Return the index of each used column, from the header line."""
+        columns = {}
+        for index, title in enumerate(header):
+            column = COLUMN_TITLES.get(title.strip())
+            if column and column not in columns:
+                columns[column] = index
+        missing = [c for c in COLUMNS if c and c not in columns]
+        if missing:
+            raise UserError(
+                _("Columns %s cannot be found in the Paypal file")
+                % ', '.join(missing))
+        return columns
+
+    def _get_paypal_line_values(self, idx, line, columns=None):
+        """Return the values of the used columns of a line, unconverted."""
+        if columns is None:
+            columns = DEFAULT_COLUMNS
+        try:
+            rline = dict(
+                (column, line[index]) for column, index in columns.items())
+        except IndexError:
+            raise UserError(
+                _("Line %d does not have all the columns of the header")
+                % idx)
+        rline['idx'] = idx
+        return rline
+
+    def _convert_paypal_values(self, rline, cache=None):
+        """Convert the date and amounts of a line, in place.
+
+        Paypal files repeat the same dates and amounts, so each distinct
+        value is converted only once. The converted values are kept in
+        cache, which is passed again for the next lines of a file."""
+        if cache is None:
+            cache = {}
+        dates = cache.setdefault('date', {})
+        amounts = cache.setdefault('amount', {})
+        date = dates.get(rline['date'])
+        if date is None:
+            date_dt = datetime.strptime(
+                rline['date'], self._get_paypal_date_format())
+            date = dates[rline['date']] = fields.Date.to_string(date_dt)
+        rline['date'] = date
         for field in ['commission', 'amount', 'balance']:
-            _logger.debug('Trying to convert %s to float' % rline[field])
-            try:
-                rline[field] = self._paypal_convert_amount(rline[field])
-            except Exception:
-                raise UserError(
-                    _("Value '%s' for the field '%s' on line %d, "
-                        "cannot be converted to float")
-                    % (rline[field], field, idx))
+            amount = amounts.get(rline[field])
+            if amount is None:
+                _logger.debug('Trying to convert %s to float', rline[field])
+                try:
+                    amount = self._paypal_convert_amount(rline[field])
+                except Exception:
+                    raise UserError(
+                        _("Value '%s' for the field '%s' on line %d, "
+                            "cannot be converted to float")
+                        % (rline[field], field, rline['idx']))
+                amounts[rline[field]] = amount
+            rline[field] = amount
         return rline
 
-    def _parse_paypal_file(self, data_file):
-        data_file = self._get_paypal_str_data(data_file)
-        f = StringIO(data_file)
-        f.seek(0)
-        raw_lines = []
-        reader = csv.reader(f)
-        next(reader)  # Drop header
+    def _convert_paypal_line_to_dict(self, idx, line, columns=None,
+                                     cache=None):
+        """Return the values of a line of the file.
+
+        columns and cache are passed to _get_paypal_line_values and
+        _convert_paypal_values."""
+        rline = self._get_paypal_line_values(idx, line, columns)
+        return self._convert_paypal_values(rline, cache)
+
+    def _iter_paypal_file(self, data_file):
+        """Yield the values of each line of the file.
+
+        The file is decoded and read one line at a time, and only the
+        columns used for the statement lines are kept. They are found from
+        the header line. Overrides of _convert_paypal_line_to_dict get the
+        lines in the columns of the HEADERS, as they did before."""
+        reader = csv.reader(self._open_paypal_file(data_file))
+        # The file may start with blank lines
+        header = next((line for line in reader if ''.join(line).strip()), [])
+        columns = self._get_paypal_columns(header)
+        convert_kwargs = {'columns': columns, 'cache': {}}
+        if self._is_paypal_hook_overridden('_convert_paypal_line_to_dict'):
+            convert_kwargs = {}
         for idx, line in enumerate(reader):
-            _logger.debug("Line %d: %s" % (idx, line))
-            raw_lines.append(self._convert_paypal_line_to_dict(idx, line))
-        return raw_lines
+            if not line:
+                continue
+            _logger.debug("Line %d: %s", idx, line)
+            if not convert_kwargs:
+                rline = self._get_paypal_line_values(idx, line, columns)
+                line = [rline[column] if column else ''
+                        for column in COLUMNS]
+            yield self._convert_paypal_line_to_dict(
+                idx, line, **convert_kwargs)
 
-    def _prepare_paypal_currency_vals(self, cline):
+    def _parse_paypal_file(self, data_file):
+        """Return the values of the lines of the file.
+
+        They are all kept, as the lines of currency changes are merged with
+        the lines they refer to, which may come later in the file."""
+        return list(self._iter_paypal_file(data_file))
+
+    @api.model
+    def _get_paypal_currencies(self, names):
+        """Return the currency of each of the ISO codes that exists.
+
+        The currencies are searched at once, so that they can be looked up
+        in the result for each line of a file. This is only needed by PayPal
+        files, which mix lines in several currencies: for the other formats,
+        account_bank_statement_import looks up the one currency of a file."""
+        if not names:
+            return {}
         currencies = self.env['res.currency'].search(
-            [('name', '=', cline['currency'])])
-        if not currencies:
+            [('name', 'in', list(set(names)))])
+        return dict((currency.name, currency) for currency in currencies)
+
+    def _prepare_paypal_currency_vals(self, cline, currencies=None):
+        """currencies maps ISO codes to currencies, as returned by
+        _get_paypal_currencies. Without it, the currency is searched."""
+        if currencies is None:
+            currencies = self._get_paypal_currencies([cline['currency']])
+        currency = currencies.get(cline['currency'])
+        if not currency:
             raise UserError(
                 _('currency %s on line %d cannot be found in odoo')
                 % (cline['currency'], cline['idx']))
         return {
             'amount_currency': cline['amount'],
-            'currency_id': currencies.id,
+            'currency_id': currency.id,
             'currency': cline['currency'],
             'partner_name': cline['partner_name'],
             'description': cline['description'],
@@ -142,15 +307,20 @@ class AccountBankStatementImport(models.TransientModel):
             else:
                 real_transactions.append(line)
 
+        # Check if the current transaction is linked with a
+        # transaction of currency change if yes merge the transaction
+        # as for odoo it's only one line
+        linked_lines = []
         for line in real_transactions:
-            # Check if the current transaction is linked with a
-            # transaction of currency change if yes merge the transaction
-            # as for odoo it's only one line
             cline = currency_change_lines.get(line['origin_transaction_id'])
             if cline:
-                # we update the current line with currency information
-                vals = self._prepare_paypal_currency_vals(cline)
-                line.update(vals)
+                linked_lines.append((line, cline))
+        currencies = self._get_paypal_currencies(
+            [cline['currency'] for line, cline in linked_lines])
+        for line, cline in linked_lines:
+            # we update the current line with currency information
+            vals = self._prepare_paypal_currency_vals(cline, currencies)
+            line.update(vals)
         return real_transactions
 
     def _prepare_paypal_statement_line(self, fline):
@@ -202,15 +372,66 @@ class AccountBankStatementImport(models.TransientModel):
 
         raw_lines = self._parse_paypal_file(data_file)
         final_lines = self._post_process_statement_line(raw_lines)
+        statements = [
+            self._get_paypal_statement_vals(lines)
+            for lines in self._split_paypal_lines(final_lines)
+        ]
+        return None, None, statements
+
+    @api.model
+    def _get_paypal_split_config(self):
+        """Return how the lines of a file are split in statements, and the
+        maximum number of lines of a statement when split by lines.
+
+        The lines are split per 'day', 'month' or 'lines'. They are not
+        split unless a mode is set."""
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        lines_key = 'account_bank_statement_import_paypal.split_lines'
+        max_lines = get_param(lines_key, 1000)
+        try:
+            max_lines = int(max_lines)
+        except ValueError:
+            # Not a ValueError, which would be taken for another format
+            raise UserError(
+                _("The system parameter %s must be an integer, not %s.")
+                % (lines_key, max_lines))
+        return (
+            get_param('account_bank_statement_import_paypal.split_mode'),
+            max_lines,
+        )
+
+    def _split_paypal_lines(self, lines):
+        """Yield the lines of each statement.
 
-        vals_bank_statement = self._prepare_paypal_statement(final_lines)
+        When split per day or month, consecutive lines of the same period
+        go in the same statement."""
+        mode, max_lines = self._get_paypal_split_config()
+        if not mode:
+            yield lines
+        elif mode == 'lines' and max_lines > 0:
+            for i in range(0, len(lines), max_lines):
+                yield lines[i:i + max_lines]
+        elif mode in SPLIT_DATE_SIZES:
+            date_size = SPLIT_DATE_SIZES[mode]
+            for period, period_lines in itertools.groupby(
+                    lines, lambda line: line['date'][:date_size]):
+                yield list(period_lines)
+        else:
+            raise UserError(
+                _("Invalid split of Paypal statements: %s, %d lines")
+                % (mode, max_lines))
+
+    def _get_paypal_statement_vals(self, lines):
+        """Return the values of a statement with its lines and a line for
+        their commissions."""
+        vals_bank_statement = self._prepare_paypal_statement(lines)
 
         transactions = []
         commission_total = 0
-        for fline in final_lines:
+        for fline in lines:
             commission_total += fline['commission']
             vals_line = self._prepare_paypal_statement_line(fline)
-            _logger.debug("vals_line = %s" % vals_line)
+            _logger.debug("vals_line = %s", vals_line)
             transactions.append(vals_line)
 
         if commission_total:
@@ -224,58 +445,140 @@ class AccountBankStatementImport(models.TransientModel):
             transactions.append(commission_line)
 
         vals_bank_statement['transactions'] = transactions
-        return None, None, [vals_bank_statement]
+        # Only the lines of PayPal statements are completed with their partner
+        vals_bank_statement['paypal'] = True
+        return vals_bank_statement
 
     @api.model
-    def _get_paypal_partner(self, description, partner_name,
-                            partner_email, invoice_number):
-        if invoice_number:
+    def _get_paypal_unique_partners(
+            self, model, field, values, domain=None, partner_field=None):
+        """Return the commercial partner of the record found for each value.
+
+        Values for which no or several records are found are left out."""
+        records = {}
+        for record in self.env[model].search(
+                [(field, 'in', list(values))] + (domain or [])):
+            records.setdefault(record[field], []).append(record)
+        partners = {}
+        for value, value_records in records.items():
+            if len(value_records) == 1:
+                partner = value_records[0]
+                if partner_field:
+                    partner = partner[partner_field]
+                partners[value] = partner.commercial_partner_id
+        return partners
+
+    @api.model
+    def _get_paypal_partners_by_name(self, names):
+        """Return the partner found for each name, as with =ilike.
+
+        Names are searched by chunks of PAYPAL_SEARCH_CHUNK_SIZE. Names with
+        wildcards are searched one at a time."""
+        partner_model = self.env['res.partner']
+        partners = {}
+        names = list(names)
+        plain_names = [
+            name for name in names if not RE_LIKE_WILDCARD.search(name)]
+        for i in range(0, len(plain_names), PAYPAL_SEARCH_CHUNK_SIZE):
+            chunk = plain_names[i:i + PAYPAL_SEARCH_CHUNK_SIZE]
+            found = {}
+            for partner in partner_model.search(expression.OR(
+                    [[('name', '=ilike', name)] for name in chunk])):
+                found.setdefault(partner.name.lower(), []).append(partner)
+            for name in chunk:
+                name_partners = found.get(name.lower(), [])
+                if len(name_partners) == 1:
+                    partners[name] = name_partners[0].commercial_partner_id
+        for name in names:
+            if RE_LIKE_WILDCARD.search(name):
+                partner = partner_model.search([('name', '=ilike', name)])
+                if partner and len(partner) == 1:
+                    partners[name] = partner.commercial_partner_id
+        return partners
+
+    @api.model
+    def _get_paypal_partner_maps(self, infos):
+        """Return the partners found for the information of lines.
+
+        infos are the description, partner name, partner email and invoice
+        number of each line. All values of a kind are searched together.
+        For each kind, the result maps the values to the partner found."""
+        invoice_numbers = set(info[3] for info in infos if info[3])
+        emails = set(info[2] for info in infos if info[2])
+        names = set(info[1] for info in infos if info[1])
+        partner_maps = {'sale': {}, 'invoice': {}, 'email': {}, 'name': {}}
+        if invoice_numbers:
             # In most case e-commerce case invoice_number
             # will contain the sale order number
-            sale = self.env['sale.order'].search([
-                ('name', '=', invoice_number)])
-            if sale and len(sale) == 1:
-                return sale.partner_id.commercial_partner_id
+            if 'sale.order' in self.env:
+                partner_maps['sale'] = self._get_paypal_unique_partners(
+                    'sale.order', 'name', invoice_numbers,
+                    partner_field='partner_id')
+            partner_maps['invoice'] = self._get_paypal_unique_partners(
+                'account.invoice', 'number', invoice_numbers,
+                partner_field='partner_id')
+        if emails:
+            partner_maps['email'] = self._get_paypal_unique_partners(
+                'res.partner', 'email', emails,
+                domain=[('parent_id', '=', False)])
+        if names:
+            partner_maps['name'] = self._get_paypal_partners_by_name(names)
+        return partner_maps
 
-            invoice = self.env['account.invoice'].search([
-                ('number', '=', invoice_number)])
-            if invoice and len(invoice) == 1:
-                return invoice.partner_id.commercial_partner_id
+    @api.model
+    def _get_paypal_partner(self, description, partner_name,
+                            partner_email, invoice_number, partner_maps=None):
+        """Return the partner of a line, from the sale order or invoice
+        number, or else the email or name of the partner.
 
+        partner_maps are the partners found for all lines of a statement,
+        by _get_paypal_partner_maps. Without them, this line is searched."""
+        if partner_maps is None:
+            partner_maps = self._get_paypal_partner_maps(
+                [(description, partner_name, partner_email, invoice_number)])
+        if invoice_number:
+            partner = (
+                partner_maps['sale'].get(invoice_number) or
+                partner_maps['invoice'].get(invoice_number))
+            if partner:
+                return partner
         if partner_email:
-            partner = self.env['res.partner'].search([
-                ('email', '=', partner_email),
-                ('parent_id', '=', False)])
-            if partner and len(partner) == 1:
-                return partner.commercial_partner_id
-
+            partner = partner_maps['email'].get(partner_email)
+            if partner:
+                return partner
         if partner_name:
-            partner = self.env['res.partner'].search([
-                ('name', '=ilike', partner_name)])
-            if partner and len(partner) == 1:
-                return partner.commercial_partner_id
+            partner = partner_maps['name'].get(partner_name)
+            if partner:
+                return partner
         return None
 
     @api.model
-    def _complete_paypal_statement_line(self, line):
-        _logger.debug('Process line %s', line['name'])
-        info = line['name'].split('|')
+    def _complete_paypal_statement_line(self, line, partner_maps=None):
+        _logger.debug('Process line %s', line.get('name'))
+        info = (line.get('name') or '').split('|')
         if len(info) == 4:
-            partner = self._get_paypal_partner(*info)
+            partner = self._get_paypal_partner(
+                *info, partner_maps=partner_maps)
             if partner:
-                return {
-                    'partner_id': partner.id,
-                    'account_id': partner.property_account_receivable.id,
-                    }
+                return {'partner_id': partner.id}
         return None
 
     @api.model
-    def _complete_statement(self, stmts_vals, journal_id, account_number):
+    def _complete_stmts_vals(self, stmts_vals, journal, account_number):
         """ Match the partner from paypal information """
+        paypal_stmts_vals = [
+            st_vals for st_vals in stmts_vals if st_vals.pop('paypal', False)]
         stmts_vals = super(AccountBankStatementImport, self).\
-            _complete_statement(stmts_vals, journal_id, account_number)
-        for line in stmts_vals['transactions']:
-            vals = self._complete_paypal_statement_line(line)
+            _complete_stmts_vals(stmts_vals, journal, account_number)
+        # The partners of the lines of all statements are searched at once
+        lines = [line for st_vals in paypal_stmts_vals
+                 for line in st_vals['transactions']]
+        infos = [(line.get('name') or '').split('|') for line in lines]
+        partner_maps = self._get_paypal_partner_maps(
+            [info for info in infos if len(info) == 4])
+        for line in lines:
+            vals = self._complete_paypal_statement_line(
+                line, partner_maps=partner_maps)
             if vals:
                 line.update(vals)
         return stmts_vals
@@ -0,0 +1,151 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo.exceptions import UserError
+from odoo.tests.common import TransactionCase
+from odoo.modules.module import get_module_resource
+import base64
+import codecs
+import csv
+import io
+
+from ..models.account_bank_statement_import_paypal import PAYPAL_SNIFF_SIZE
+
+
+class TestPaypalFile(TransactionCase):
+    """Tests for import bank statement paypal file format
+    (account.bank.statement.import)
+    """
+
+    def setUp(self):
+        super(TestPaypalFile, self).setUp()
+        self.statement_import_model = self.env['account.bank.statement.import']
+        self.statement_line_model = self.env['account.bank.statement.line']
+        self.journal = self.env['account.journal'].create({
+            'name': 'Test paypal journal',
+            'code': 'TPPL',
+            'type': 'bank',
+            'currency_id': self.env.ref('base.EUR').id,
+        })
+        paypal_file_path = get_module_resource(
+            'account_bank_statement_import_paypal', 'tests', 'test_paypal.csv',
+        )
+        self.data = open(paypal_file_path, 'rb').read()
+
+    def test_paypal_file_import(self):
+        partner_alice = self.env['res.partner'].create({
+            'name': 'Alice',
+            'email': 'alice@example.com',
+        })
+        partner_carol = self.env['res.partner'].create({
+            'name': 'Carol Buyer',
+        })
+        wizard = self.statement_import_model.with_context(
+            journal_id=self.journal.id
+        ).create(
+            dict(data_file=base64.b64encode(self.data))
+        )
+        wizard.import_file()
+        lines = self.statement_line_model.search(
+            [('journal_id', '=', self.journal.id)])
+        self.assertEqual(len(lines.mapped('statement_id')), 1)
+        partners = dict((line.ref, line.partner_id) for line in lines)
+        # Found from the email, then from the name
+        self.assertEqual(partners['TX001'], partner_alice)
+        self.assertEqual(partners['TX003'], partner_carol)
+        self.assertFalse(partners['TX002'])
+        # Bank transfers have no partner information
+        self.assertFalse(partners['TX004'])
+        # The lines are left to be reconciled against the partner
+        self.assertFalse(lines.mapped('account_id'))
+        # Statements of other formats are not completed
+        stmts_vals = [{'transactions': [
+            {'name': 'Payment|Alice|alice@example.com|', 'amount': 1.0}]}]
+        self.statement_import_model._complete_stmts_vals(
+            stmts_vals, self.journal, False)
+        self.assertFalse(stmts_vals[0]['transactions'][0].get('partner_id'))
+
+    def _get_statements(self, data=None):
+        return self.statement_import_model.with_context(
+            journal_id=self.journal.id
+        )._parse_file(data or self.data)[2]
+
+    def test_paypal_check(self):
+        self.assertTrue(self.statement_import_model._check_paypal(self.data))
+        data = codecs.BOM_UTF8 + self.data
+        self.assertTrue(self.statement_import_model._check_paypal(data))
+        self.assertEqual(self._get_statements(data), self._get_statements())
+        self.assertFalse(self.statement_import_model._check_paypal(
+            codecs.BOM_UTF8 + b'"Date","Amount"'))
+        # Only the start of the file is decoded to detect it
+        self.assertTrue(self.statement_import_model._check_paypal(
+            self.data + b'\n' * PAYPAL_SNIFF_SIZE + b'\xff'))
+        self.assertFalse(self.statement_import_model._check_paypal(
+            b'\xff' + self.data))
+
+    def test_paypal_columns(self):
+        rows = list(csv.reader(io.StringIO(self.data.decode('utf-8'))))
+        # Columns in another order, with a column that is not used
+        data = io.StringIO()
+        writer = csv.writer(data)
+        for row in rows:
+            writer.writerow(list(reversed(row)) + ['Note'])
+        data = data.getvalue().encode('utf-8')
+        self.assertEqual(
+            self.statement_import_model._parse_paypal_file(data),
+            self.statement_import_model._parse_paypal_file(self.data))
+        wizard = self.statement_import_model.with_context(
+            journal_id=self.journal.id
+        ).create(
+            dict(data_file=base64.b64encode(data))
+        )
+        wizard.import_file()
+        lines = self.statement_line_model.search(
+            [('journal_id', '=', self.journal.id)])
+        self.assertEqual(
+            sorted(lines.mapped('ref')),
+            ['PAYPAL-COSTS', 'TX001', 'TX002', 'TX003', 'TX004', 'TX005'])
+        rows[0][9] = 'Reference'
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        self.assertFalse(self.statement_import_model._check_paypal(
+            data.getvalue().encode('utf-8')))
+        with self.assertRaises(UserError):
+            self.statement_import_model._parse_paypal_file(
+                data.getvalue().encode('utf-8'))
+
+    def test_paypal_currency_not_found(self):
+        with self.assertRaises(UserError):
+            self._get_statements(self.data.replace(b'"USD"', b'"XYZ"'))
+
+    def test_paypal_split(self):
+        set_param = self.env['ir.config_parameter'].sudo().set_param
+        set_param('account_bank_statement_import_paypal.split_lines', '2')
+        for mode, balances, commissions in [
+                (False, [(100.0, 54.12)], [-6.48]),
+                ('day', [(100.0, 245.05), (245.05, 264.17),
+                         (264.17, 63.82), (63.82, 54.12)],
+                 [-4.95, -0.88, -0.35, -0.3]),
+                ('month', [(100.0, 264.17), (264.17, 54.12)],
+                 [-5.83, -0.65]),
+                ('lines', [(100.0, 245.05), (245.05, 63.82),
+                           (63.82, 54.12)],
+                 [-4.95, -1.23, -0.3]),
+                ]:
+            set_param('account_bank_statement_import_paypal.split_mode', mode)
+            statements = self._get_statements()
+            self.assertEqual(len(statements), len(balances))
+            for statement, (balance_start, balance_end), commission in zip(
+                    statements, balances, commissions):
+                self.assertAlmostEqual(
+                    statement['balance_start'], balance_start, 2)
+                self.assertAlmostEqual(
+                    statement['balance_end_real'], balance_end, 2)
+                commission_lines = [
+                    line for line in statement['transactions']
+                    if line['ref'] == 'PAYPAL-COSTS']
+                self.assertEqual(len(commission_lines), 1)
+                self.assertAlmostEqual(
+                    commission_lines[0]['amount'], commission, 2)
+        set_param('account_bank_statement_import_paypal.split_lines', 'ten')
+        with self.assertRaises(UserError):
+            self._get_statements()
@@ -7,6 +7,7 @@
 from odoo.tests.common import TransactionCase
 from odoo.modules.module import get_module_resource
 import base64
+import datetime
 
 
 class TestQifFile(TransactionCase):
@@ -47,3 +48,46 @@ class TestQifFile(TransactionCase):
             [('name', '=', 'Epic Technologies')], limit=1,
         )
         self.assertEqual(line.partner_id, self.partner)
+
+    def test_qif_dates(self):
+        qif_file_path = get_module_resource(
+            'account_bank_statement_import_qif', 'tests', 'test_qif.qif',
+        )
+        data = open(qif_file_path, 'rb').read()
+        transactions = self.statement_import_model._parse_file(
+            data.replace(b'\n', b'\r\n'))[2][0]['transactions']
+        self.assertEqual(
+            [line['date'] for line in transactions[:2]],
+            [datetime.date(2013, 8, 12), datetime.date(2013, 8, 15)])
+        # A date that can only be read day first gives the file layout
+        transactions = self.statement_import_model._parse_file(data.replace(
+            b'D8/15/13', b'D25/12/2013'))[2][0]['transactions']
+        self.assertEqual(
+            [line['date'] for line in transactions[:4]],
+            [datetime.date(2013, 12, 8), datetime.date(2013, 12, 25),
+             datetime.date(2013, 3, 3), datetime.date(2013, 4, 3)])
+        self.assertEqual(
+            self.statement_import_model._parse_qif_date("12/25'05"),
+            datetime.date(2005, 12, 25))
+        self.assertEqual(
+            self.statement_import_model._parse_qif_date('Aug 12, 2013'),
+            datetime.date(2013, 8, 12))
+
+    def test_qif_partner_match(self):
+        partner = self.env['res.partner'].create({'name': 'Zorglub'})
+        partner_systems = self.env['res.partner'].create({
+            'name': 'Zorglub Systems',
+        })
+        names = set(['ZORGLUB', 'zorglub sys', 'Zorglub_Systems'])
+        partner_ids = self.statement_import_model._get_qif_partner_ids(names)
+        for name in names:
+            self.assertEqual(
+                partner_ids[name],
+                self.env['res.partner'].search(
+                    [('name', 'ilike', name)], limit=1).id)
+        self.assertEqual(partner_ids['zorglub sys'], partner_systems.id)
+        self.env['ir.config_parameter'].sudo().set_param(
+            'account_bank_statement_import_qif.partner_match', 'exact')
+        partner_ids = self.statement_import_model._get_qif_partner_ids(names)
+        self.assertEqual(partner_ids['ZORGLUB'], partner.id)
+        self.assertFalse(partner_ids['zorglub sys'])
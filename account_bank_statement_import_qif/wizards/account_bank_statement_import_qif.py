@@ -4,11 +4,108 @@
 # Copyright 2016-2017 Tecnativa - Pedro M. Baeza
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+import bisect
+import collections
+import datetime
+import re
+import time
+
 import dateutil.parser
 
 from odoo.tools.translate import _
 from odoo import api, models
 from odoo.exceptions import UserError
+from odoo.osv import expression
+
+RE_QIF_LINE = re.compile(r'[^\r\n]+')
+# Numeric dates, like 8/12/13, 12/25'05, 31.12.2013 or 2013-12-31
+RE_QIF_DATE = re.compile(
+    r"^(\d{1,4})\s*[-/.']\s*(\d{1,2})\s*[-/.']\s*(\d{1,4})$")
+
+# Partner matching policies: first partner, in their order, whose name
+# contains the payee (as an ilike search), or partner named as the payee
+QIF_PARTNER_MATCH_POLICIES = ('first', 'exact')
+# Below this number of payees, the partner index only has the partners whose
+# name contains one of them
+QIF_PARTNER_INDEX_MIN_NAMES = 50
+# Characters of payees that ilike does not match literally
+RE_LIKE_WILDCARD = re.compile(r'[%_\\]')
+
+
+class PartnerNameIndex(object):
+    """Find partners by name in memory.
+
+    Names are compared case insensitively. The partners are kept in their
+    order, so that the first partner whose name contains a payee is the one
+    an ilike search finds first."""
+
+    def __init__(self, partners):
+        """Index partners, a list of dictionaries with id and name."""
+        self.ids = []
+        self.offsets = []
+        self.exact_ids = {}
+        keys = []
+        offset = 0
+        for partner in partners:
+            key = partner['name'].lower()
+            self.ids.append(partner['id'])
+            self.offsets.append(offset)
+            keys.append(key)
+            offset += len(key) + 1
+            self.exact_ids.setdefault(key.strip(), partner['id'])
+        # Payees have no new line, so they match within a single name
+        self.text = '\n'.join(keys)
+
+    def find_first(self, name):
+        """Return the id of the first partner whose name contains name."""
+        position = self.text.find(name.lower())
+        if position < 0:
+            return None
+        return self.ids[bisect.bisect_right(self.offsets, position) - 1]
+
+    def find_exact(self, name):
+        """Return the id of the first partner named name."""
+        return self.exact_ids.get(name.lower().strip())
+
+
+def iter_qif_lines(file_data):
+    """Yield the stripped, non empty lines of a QIF file, one at a time."""
+    for match in RE_QIF_LINE.finditer(file_data):
+        line = match.group().strip()
+        if line:
+            yield line
+
+
+def convert_year(year):
+    """Return the year of a two digits year, as dateutil does."""
+    this_year = time.localtime().tm_year
+    year += this_year // 100 * 100
+    if year >= this_year + 50:
+        year -= 100
+    elif year < this_year - 50:
+        year += 100
+    return year
+
+
+def get_qif_date_fields(value, day_first=False):
+    """Return year, month and day of a numeric date, or None.
+
+    Dates starting with a four digits year are read year first. Other dates
+    are read day first or month first, depending on day_first."""
+    match = RE_QIF_DATE.match(value)
+    if not match:
+        return None
+    first, second, third = match.groups()
+    if len(first) == 4:
+        if len(third) > 2:
+            return None
+        return int(first), int(second), int(third)
+    if len(first) > 2 or len(third) not in (2, 4):
+        return None
+    year = int(third) if len(third) == 4 else convert_year(int(third))
+    if day_first:
+        return year, int(second), int(first)
+    return year, int(first), int(second)
 
 
 class AccountBankStatementImport(models.TransientModel):
@@ -24,26 +121,22 @@ class AccountBankStatementImport(models.TransientModel):
                 data_file)
         try:
             file_data = data_file.decode()
-            if '\r' in file_data:
-                data_list = file_data.split('\r')
-            else:
-                data_list = file_data.split('\n')
-            header = data_list[0].strip()
+            lines = iter_qif_lines(file_data)
+            header = next(lines)
             header = header.split(":")[1]
         except:
             raise UserError(_('Could not decipher the QIF file.'))
         transactions = []
         vals_line = {}
         total = 0
+        # Dates are parsed once the file is read, each value once
+        date_values = collections.OrderedDict()
         if header in ("Bank", "CCard"):
             vals_bank_statement = {}
-            for line in data_list:
-                line = line.strip()
-                if not line:
-                    continue
+            for line in lines:
                 if line[0] == 'D':  # date of transaction
-                    vals_line['date'] = dateutil.parser.parse(
-                        line[1:], fuzzy=True).date()
+                    vals_line['date'] = line[1:].strip()
+                    date_values[vals_line['date']] = None
                 elif line[0] == 'T':  # Total amount
                     total += float(line[1:].replace(',', ''))
                     vals_line['amount'] = float(line[1:].replace(',', ''))
@@ -68,12 +161,58 @@ class AccountBankStatementImport(models.TransientModel):
         else:
             raise UserError(_('This file is either not a bank statement or is '
                               'not correctly formed.'))
+        dates = self._parse_qif_dates(list(date_values))
+        for vals_line in transactions:
+            if 'date' in vals_line:
+                vals_line['date'] = dates[vals_line['date']]
         vals_bank_statement.update({
             'balance_end_real': total,
             'transactions': transactions
         })
         return None, None, [vals_bank_statement]
 
+    @api.model
+    def _is_qif_day_first(self, values):
+        """Return whether the dates of a QIF file are written day first.
+
+        The layout is given by the first date that can only be read one way,
+        like 25/12/13. If there is none, dates are read month first, like
+        Quicken writes them."""
+        for value in values:
+            match = RE_QIF_DATE.match(value)
+            if not match or len(match.group(1)) > 2:
+                continue
+            first, second = int(match.group(1)), int(match.group(2))
+            if first > 12 and second <= 12:
+                return True
+            if second > 12 and first <= 12:
+                return False
+        return False
+
+    @api.model
+    def _parse_qif_date(self, value, day_first=False):
+        """Return the date of a QIF date value.
+
+        Numeric dates are read in the layout of the file. Other values are
+        parsed by dateutil."""
+        fields = get_qif_date_fields(value, day_first)
+        if fields:
+            try:
+                return datetime.date(*fields)
+            except ValueError:
+                pass
+        return dateutil.parser.parse(
+            value, fuzzy=True, dayfirst=day_first).date()
+
+    @api.model
+    def _parse_qif_dates(self, values):
+        """Return a dictionary of the date of each distinct date value."""
+        day_first = self._is_qif_day_first(values)
+        return dict(
+            (value, self._parse_qif_date(value, day_first))
+            for value in values
+        )
+
     def _complete_stmts_vals(self, stmt_vals, journal_id, account_number):
         """Match partner_id if hasn't been deducted yet."""
         res = super(AccountBankStatementImport, self)._complete_stmts_vals(
@@ -82,12 +221,60 @@ class AccountBankStatementImport(models.TransientModel):
         # Since QIF doesn't provide account numbers (normal behaviour is to
         # provide 'account_number', which the generic module uses to find
         # the partner), we have to find res.partner through the name
-        partner_obj = self.env['res.partner']
-        for statement in res:
-            for line_vals in statement['transactions']:
-                if not line_vals.get('partner_id') and line_vals.get('name'):
-                    partner = partner_obj.search(
-                        [('name', 'ilike', line_vals['name'])], limit=1,
-                    )
-                    line_vals['partner_id'] = partner.id
+        lines = [
+            line_vals
+            for statement in res
+            for line_vals in statement['transactions']
+            if not line_vals.get('partner_id') and line_vals.get('name')
+        ]
+        partner_ids = self._get_qif_partner_ids(
+            set(line_vals['name'] for line_vals in lines))
+        for line_vals in lines:
+            line_vals['partner_id'] = partner_ids[line_vals['name']]
         return res
+
+    @api.model
+    def _get_qif_partner_match_policy(self):
+        """Return the configured policy to match partners with payees."""
+        policy = self.env['ir.config_parameter'].sudo().get_param(
+            'account_bank_statement_import_qif.partner_match', 'first')
+        if policy not in QIF_PARTNER_MATCH_POLICIES:
+            raise UserError(_(
+                "Invalid partner matching policy %s. It should be one of: %s."
+            ) % (policy, ', '.join(QIF_PARTNER_MATCH_POLICIES)))
+        return policy
+
+    @api.model
+    def _get_qif_partner_index(self, names):
+        """Return an index of the partners that may match names."""
+        domain = [('name', '!=', False)]
+        if len(names) < QIF_PARTNER_INDEX_MIN_NAMES:
+            domain = expression.AND([domain, expression.OR(
+                [[('name', 'ilike', name)] for name in names])])
+        return PartnerNameIndex(
+            self.env['res.partner'].search_read(domain, ['name']))
+
+    @api.model
+    def _get_qif_partner_ids(self, names):
+        """Return a dictionary of the partner id of each payee.
+
+        Each payee is looked up once, in an index of the partners. Payees
+        with wildcards are searched as before, one at a time."""
+        if not names:
+            return {}
+        policy = self._get_qif_partner_match_policy()
+        partner_ids = {}
+        if policy == 'first':
+            plain_names = set(
+                name for name in names if not RE_LIKE_WILDCARD.search(name))
+            for name in names - plain_names:
+                partner_ids[name] = self.env['res.partner'].search(
+                    [('name', 'ilike', name)], limit=1).id
+        else:
+            plain_names = names
+        if plain_names:
+            index = self._get_qif_partner_index(plain_names)
+            find = index.find_first if policy == 'first' else index.find_exact
+            for name in plain_names:
+                partner_ids[name] = find(name) or False
+        return partner_ids